@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+# Choice of the momentum offsets to track for an adaptive tune survey.
+#
+# The survey starts from every step-th point of the full offset grid and
+# then adds grid points only inside the intervals where linear
+# interpolation of the tune curve between the tracked points is not good
+# enough: where the estimated interpolation error from the curvature is
+# above tol, or where the interpolated tunes differ from the measured
+# tunes by more than residual_tol. All indices are into the full grid.
+
+# every step-th index of a grid of n points, always including the ends
+def coarse_indices(n, step):
+    indices = list(range(0, n, step))
+    if indices[-1] != n-1:
+        indices.append(n-1)
+    return np.array(indices)
+
+#-----------------------------------------------------------------------
+
+# Estimated error of linear interpolation in each interval between the
+# tracked points x (sorted) with tunes of shape (points, planes): h**2/8
+# times the largest second divided difference at either end.
+def interpolation_errors(x, tunes):
+    h = np.diff(x)
+    slopes = np.diff(tunes, axis=0) / h[:, np.newaxis]
+    curvature = np.zeros(tunes.shape)
+    curvature[1:-1] = 2.0*np.abs(np.diff(slopes, axis=0)) / (x[2:] - x[:-2])[:, np.newaxis]
+    # the ends get the curvature of their neighbour
+    if len(x) > 2:
+        curvature[0] = curvature[1]
+        curvature[-1] = curvature[-2]
+    interval_curvature = np.maximum(curvature[:-1], curvature[1:])
+    return np.max(interval_curvature, axis=1) * h**2 / 8.0
+
+# the largest difference in each interval between the tunes interpolated
+# onto the untracked grid points and the measured tunes there
+def interval_residuals(grid, tracked, tunes, measured):
+    diff = np.max(np.abs(interpolate(grid, tracked, tunes) - measured), axis=1)
+    residuals = np.zeros(len(tracked)-1)
+    for k in range(len(tracked)-1):
+        inside = diff[tracked[k]+1:tracked[k+1]]
+        if len(inside):
+            residuals[k] = np.max(inside)
+    return residuals
+
+#-----------------------------------------------------------------------
+
+# Grid indices to track next: the middle grid point of every interval
+# between the sorted tracked indices that has untracked points and fails
+# the tolerances. Returns an empty array once the grid is good enough.
+def refine(grid, tracked, tunes, tol, measured=None, residual_tol=None):
+    bad = interpolation_errors(grid[tracked], tunes) > tol
+    if measured is not None and residual_tol:
+        bad = bad | (interval_residuals(grid, tracked, tunes, measured) > residual_tol)
+    new = []
+    for k in np.nonzero(bad)[0]:
+        if tracked[k+1] - tracked[k] > 1:
+            new.append((tracked[k] + tracked[k+1])//2)
+    return np.array(new, dtype=int)
+
+# the tunes at the tracked indices interpolated onto the full grid
+def interpolate(grid, tracked, tunes):
+    return np.column_stack([np.interp(grid, grid[tracked], tunes[:, p]) for p in range(tunes.shape[1])])
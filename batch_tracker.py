@@ -0,0 +1,464 @@
+#!/usr/bin/env python
+
+import time
+import numpy as np
+
+import evaluate
+import rr_tune_survey
+import rr_setup
+import rrnova_qt60x
+import reduced_lattice
+import taylor_map
+import tune_suite
+import adaptive_grid
+import stage_timing
+from rr_options import opts
+
+# Tune surveys of many knob settings (candidates) in one NumPy
+# propagation.
+#
+# Only the MPS*U shims depend on the knobs, plus the qt60x trim quads
+# when the tunes are adjusted. Everything between them is the same for
+# every candidate, so the ring is cut at the shims and trims into fixed
+# segments. The map of each segment is fitted once per template with
+# taylor_map, from sample particles tracked through the segment by
+# synergia. The fit is to order batch_map_order in x, x', y, y' and
+# dp/p so the segments keep their chromatic and nonlinear terms. The
+# candidates then differ only in the thin shim kicks and the thick trim
+# quads. Those are applied with the candidate as a batch dimension: the
+# coordinates have shape (candidates, particles, 6) and every turn moves
+# all the candidates and momentum offsets at once.
+#
+# The tune adjustment and the starting dispersion orbit of a candidate
+# come from its linear one turn matrix, the product of the linear parts
+# of the pieces, rather than from synergia.
+
+# rows and columns of the (x, x', y, y', dp/p) linear matrices in the
+# 6 coordinates
+linear_coords = [0, 1, 2, 3, 5]
+
+# why a survey was stopped at turn by particle n with amplitude
+def stop_reason(n, amplitude, abort_amplitude, turn):
+    if abort_amplitude:
+        return "particle {} amplitude {} beyond {} at turn {}".format(n, amplitude, abort_amplitude, turn)
+    return "particle {} amplitude {} not finite at turn {}".format(n, amplitude, turn)
+
+#-----------------------------------------------------------------------
+
+# Tangent-linear versions of the shim kick and the trim quad for one
+# candidate. coords has shape (1, particles, 6) and tangents, the
+# derivatives of coords by the knobs, (knobs, particles, 6). Both are
+# changed in place, tangents first since they need the coordinates at
+# the start of the piece.
+
+# db of shape (knobs, 6) is the derivative of the strengths b (1, 6)
+# by each knob
+def multipole_kick_tangent(coords, tangents, b, db):
+    z = coords[..., 0] + 1j*coords[..., 2]
+    dz = tangents[..., 0] + 1j*tangents[..., 2]
+    nmax = b.shape[1] - 1
+    # d/dz of sum b_n z**n and sum db_n z**n
+    slope = np.zeros_like(z) + nmax*b[:, nmax, np.newaxis]
+    dkick = np.zeros_like(dz) + db[:, nmax, np.newaxis]
+    for n in range(nmax-1, -1, -1):
+        if n > 0:
+            slope = slope*z + n*b[:, n, np.newaxis]
+        dkick = dkick*z + db[:, n, np.newaxis]
+    dkick = dkick + slope*dz
+    tangents[..., 1] -= dkick.real
+    tangents[..., 3] += dkick.imag
+    reduced_lattice.multipole_kick(coords, b)
+
+# k1 has shape (1,) and dk1 (knobs,), the derivative of k1 by each knob
+def thick_quad_tangent(coords, tangents, k1, dk1, length):
+    pscale = 1.0 + coords[..., 5]
+    k = k1[:, np.newaxis] / pscale
+    dk = dk1[:, np.newaxis] / pscale
+    # derivatives of the quad functions by k from central differences
+    h = 1.0e-6*max(abs(k1[0]), 1.0e-2)
+    for (u, pu, ku, dku) in ((0, 1, k, dk), (2, 3, -k, -dk)):
+        (c, s, cp) = reduced_lattice.quad_functions(ku, length)
+        (cplus, splus, cpplus) = reduced_lattice.quad_functions(ku + h, length)
+        (cminus, sminus, cpminus) = reduced_lattice.quad_functions(ku - h, length)
+        (dc, ds, dcp) = ((cplus - cminus)/(2.0*h), (splus - sminus)/(2.0*h), (cpplus - cpminus)/(2.0*h))
+        u0 = coords[..., u]
+        up = coords[..., pu] / pscale
+        du = tangents[..., u].copy()
+        dup = tangents[..., pu] / pscale
+        tangents[..., u] = c*du + s*dup + (dc*u0 + ds*up)*dku
+        tangents[..., pu] = (cp*du + c*dup + (dcp*u0 + dc*up)*dku) * pscale
+    reduced_lattice.thick_quad(coords, k1, length)
+
+#-----------------------------------------------------------------------
+
+# The ring cut into pieces: fitted segment maps, knob dependent shims
+# and trim quads, in lattice order. The lattice must have the knobs at
+# 0 and its RF is turned off.
+
+class Batch_lattice:
+    def __init__(self, lattice, knob_elements, order, scales):
+        rr_setup.setup_rf_cavities(lattice, 0, 588)
+        self.pieces = []
+        self.maps = []
+        # (knl at knob 0, [(n, knob)]) of every shim
+        self.shims = []
+        # (quadnum, length, k1) of every trim quad
+        self.trims = []
+
+        elements = []
+        for elem in lattice.get_elements():
+            name = elem.get_name()
+            mo = reduced_lattice.trim_regex.match(name)
+            if name in knob_elements:
+                self.add_segment(lattice, elements, order, scales)
+                elements = []
+                knl = np.array([elem.get_double_attribute("k{}l".format(n), 0.0) for n in range(6)])
+                knobs = [(int(attr[1]), knob) for attr, knob in knob_elements[name]]
+                self.pieces.append(("shim", len(self.shims)))
+                self.shims.append((knl, knobs))
+            elif mo and elem.get_type_name() == "quadrupole":
+                self.add_segment(lattice, elements, order, scales)
+                elements = []
+                self.pieces.append(("trim", len(self.trims)))
+                self.trims.append((int(mo.group(1)), elem.get_length(), elem.get_double_attribute("k1", 0.0)))
+            else:
+                elements.append(elem)
+        self.add_segment(lattice, elements, order, scales)
+
+        if not self.shims:
+            raise RuntimeError("Batch_lattice: no knob dependent elements in lattice")
+
+    def add_segment(self, lattice, elements, order, scales):
+        if not elements:
+            return
+        samples = taylor_map.get_samples(order, scales, len(self.maps))
+        coords_out = reduced_lattice.track_elements(lattice, elements, samples)
+        segment_map = taylor_map.Taylor_map.fit(samples, coords_out, order, taylor_map.map_variables, scales)
+        linear = segment_map.linear_part()[linear_coords]
+        self.pieces.append(("map", len(self.maps)))
+        self.maps.append((segment_map, linear))
+
+    # the shim strengths knl/n! of the candidates kxl_list, shape
+    # (shims, candidates, 6)
+    def shim_strengths(self, kxl_list):
+        b = np.zeros((len(self.shims), len(kxl_list), 6))
+        for k, (knl, knobs) in enumerate(self.shims):
+            b[k] = knl
+            for (n, knob) in knobs:
+                b[k, :, n] += [kxl_values.get(knob, 0) for kxl_values in kxl_list]
+        return b / reduced_lattice.factorials
+
+    # the template trim k1 for ncand candidates, shape (trims, candidates)
+    def base_trim_strengths(self, ncand):
+        return np.repeat(np.array([[k1] for (quadnum, length, k1) in self.trims]), ncand, axis=1)
+
+    # The linear one turn matrices in (x, x', y, y', dp/p) on momentum of
+    # the candidates with shim strengths b and trim k1, shape
+    # (candidates, 5, 5).
+    def one_turn_matrices(self, b, trim_k1):
+        ncand = b.shape[1]
+        matrices = np.repeat(np.identity(5)[np.newaxis], ncand, axis=0)
+        for (kind, k) in self.pieces:
+            piece = np.repeat(np.identity(5)[np.newaxis], ncand, axis=0)
+            if kind == "map":
+                piece[:] = self.maps[k][1]
+            elif kind == "shim":
+                piece[:, 1, 0] = -b[k, :, 1]
+                piece[:, 3, 2] = b[k, :, 1]
+            else:
+                length = self.trims[k][1]
+                for (u, ku) in ((0, trim_k1[k]), (2, -trim_k1[k])):
+                    (c, s, cp) = reduced_lattice.quad_functions(ku, length)
+                    piece[:, u, u] = c
+                    piece[:, u, u+1] = s
+                    piece[:, u+1, u] = cp
+                    piece[:, u+1, u+1] = c
+            matrices = piece @ matrices
+        return matrices
+
+    # The trim k1 that move the tunes of each candidate to the
+    # xtune_adjust and ytune_adjust options like generate_lattice()
+    # does, shape (trims, candidates), and for each candidate None or
+    # the reason its tunes could not be found.
+    def adjusted_trim_strengths(self, b):
+        matrices = self.one_turn_matrices(b, self.base_trim_strengths(b.shape[1]))
+        trim_k1 = self.base_trim_strengths(b.shape[1])
+        reasons = []
+        for c in range(b.shape[1]):
+            try:
+                (xtune, ytune) = tune_suite.eigentunes(matrices[c, 0:4, 0:4], opts.prescreen_tol)
+            except RuntimeError as e:
+                reasons.append("batch tune adjustment: {}".format(e))
+                continue
+            delta_xtune = opts.xtune_adjust - xtune if opts.xtune_adjust else 0.0
+            delta_ytune = opts.ytune_adjust - ytune if opts.ytune_adjust else 0.0
+            kcoeff = rrnova_qt60x.get_rr60_trombone_settings(delta_xtune, delta_ytune) / 0.3048
+            for k, (quadnum, length, k1) in enumerate(self.trims):
+                trim_k1[k, c] = kcoeff[quadnum - 1]
+            reasons.append(None)
+        return (trim_k1, reasons)
+
+    # The starting coordinates of the survey particles at dpop_offsets
+    # for each candidate, on its dispersion orbit from the one turn
+    # matrices, shape (candidates, particles, 6). As in
+    # rr_tune_survey.get_initial_coords() the on momentum particle
+    # gets a small offset.
+    def initial_coords(self, matrices, dpop_offsets):
+        ncand = matrices.shape[0]
+        dispersion = np.linalg.solve(np.identity(4) - matrices[:, 0:4, 0:4], matrices[:, 0:4, 4:5])[..., 0]
+        coords = np.zeros((ncand, len(dpop_offsets), 6))
+        coords[:, :, 0:4] = dispersion[:, np.newaxis, :] * dpop_offsets[np.newaxis, :, np.newaxis]
+        coords[:, :, 5] = dpop_offsets
+        on_momentum = (dpop_offsets == 0.0)
+        coords[:, on_momentum, 0] = 1.0e-7
+        coords[:, on_momentum, 2] = 1.0e-7
+        return coords
+
+    # Track coords of shape (candidates, particles, 6) for turns turns.
+    # Returns the x and y tracks, shape (turns+1, candidates,
+    # particles, 2), and for each candidate None or the reason it was
+    # stopped: a particle beyond abort_amplitude or not finite. The
+    # particles of a stopped candidate are set to 0 for the rest of the
+    # turns.
+    def track(self, coords, b, trim_k1, turns, abort_amplitude=None):
+        ncand = coords.shape[0]
+        tracks = np.zeros((turns+1, ncand, coords.shape[1], 2))
+        tracks[0] = coords[..., [0, 2]]
+        reasons = [None]*ncand
+        stopped = np.zeros(ncand, dtype=bool)
+
+        with np.errstate(all='ignore'):
+            for turn in range(1, turns+1):
+                for (kind, k) in self.pieces:
+                    if kind == "map":
+                        coords = self.maps[k][0].apply(coords)
+                    elif kind == "shim":
+                        reduced_lattice.multipole_kick(coords, b[k])
+                    else:
+                        reduced_lattice.thick_quad(coords, trim_k1[k], self.trims[k][1])
+
+                amplitude = np.max(np.abs(coords[..., [0, 2]]), axis=2)
+                if abort_amplitude:
+                    bad = np.logical_not(amplitude <= abort_amplitude)
+                else:
+                    bad = np.logical_not(np.isfinite(amplitude))
+                for c in np.nonzero(np.any(bad, axis=1) & np.logical_not(stopped))[0]:
+                    n = np.nonzero(bad[c])[0][0]
+                    reasons[c] = stop_reason(n, amplitude[c, n], abort_amplitude, turn)
+                    stopped[c] = True
+                coords[stopped] = 0.0
+                tracks[turn] = coords[..., [0, 2]]
+                if np.all(stopped):
+                    break
+
+        return (tracks, reasons)
+
+    # Track coords of shape (1, particles, 6) of one candidate together
+    # with tangents of shape (knobs, particles, 6), their derivatives by
+    # the knobs, for turns turns. db of shape (shims, knobs, 6) and dk1
+    # of shape (trims, knobs) are the derivatives of the strengths b and
+    # trim_k1 of the candidate by the knobs. Returns the x and y tracks,
+    # shape (turns+1, particles, 2), their derivatives, shape (turns+1,
+    # knobs, particles, 2), and None or the reason the tracking stopped.
+    def track_tangents(self, coords, tangents, b, db, trim_k1, dk1, turns, abort_amplitude=None):
+        tracks = np.zeros((turns+1, coords.shape[1], 2))
+        dtracks = np.zeros((turns+1,) + tangents.shape[:2] + (2,))
+        tracks[0] = coords[0][:, [0, 2]]
+        dtracks[0] = tangents[..., [0, 2]]
+
+        with np.errstate(all='ignore'):
+            for turn in range(1, turns+1):
+                for (kind, k) in self.pieces:
+                    if kind == "map":
+                        segment_map = self.maps[k][0]
+                        tangents = np.einsum('pij,kpj->kpi', segment_map.jacobian(coords)[0], tangents)
+                        coords = segment_map.apply(coords)
+                    elif kind == "shim":
+                        multipole_kick_tangent(coords, tangents, b[k], db[k])
+                    else:
+                        thick_quad_tangent(coords, tangents, trim_k1[k], dk1[k], self.trims[k][1])
+
+                tracks[turn] = coords[0][:, [0, 2]]
+                dtracks[turn] = tangents[..., [0, 2]]
+                amplitude = np.max(np.abs(tracks[turn]), axis=1)
+                bad = np.logical_not(amplitude <= abort_amplitude) if abort_amplitude else \
+                    np.logical_not(np.isfinite(amplitude))
+                if np.any(bad):
+                    n = np.nonzero(bad)[0][0]
+                    reason = stop_reason(n, amplitude[n], abort_amplitude, turn)
+                    return (tracks[:turn+1], dtracks[:turn+1], reason)
+
+        return (tracks, dtracks, None)
+
+#-----------------------------------------------------------------------
+
+# The Batch_lattice of the template is built once per process and redone
+# when the template, the map order or the survey offsets change.
+
+batch_lattices = {}
+
+def get_batch_lattice():
+    knob_lattice = evaluate.get_knob_bound_lattice()
+    key = (knob_lattice.lattice_json, opts.batch_map_order, tuple(rr_tune_survey.get_dpop_offsets()))
+    if key not in batch_lattices:
+        with stage_timing.stage("segment_maps"):
+            lattice = knob_lattice.get_lattice({})
+            scales = reduced_lattice.get_fit_scales(lattice)
+            batch_lattices.clear()
+            batch_lattices[key] = Batch_lattice(lattice, knob_lattice.knob_elements, opts.batch_map_order, scales)
+    return batch_lattices[key]
+
+#-----------------------------------------------------------------------
+
+# Evaluate the list of kxl_values dicts with the batch tracker,
+# opts.batch_size candidates per propagation. The turns and tracked
+# offsets follow the fidelity level as in evaluate(). Returns the
+# Evaluations in the order of kxl_list.
+
+def evaluate_batch(kxl_list, adjust_tunes=True, fidelity="full"):
+    results = []
+    for start in range(0, len(kxl_list), opts.batch_size):
+        results.extend(evaluate_chunk(kxl_list[start:start+opts.batch_size], adjust_tunes, fidelity))
+    return results
+
+def evaluate_chunk(kxl_list, adjust_tunes=True, fidelity="full"):
+    level = evaluate.get_fidelity_level(fidelity)
+    batch = get_batch_lattice()
+
+    dpop_offsets = rr_tune_survey.get_dpop_offsets()
+    tracked = None
+    if level['offset_step'] > 1:
+        grid = rr_tune_survey.get_freq_offsets()
+        tracked = adaptive_grid.coarse_indices(len(grid), level['offset_step'])
+        dpop_offsets = dpop_offsets[tracked]
+
+    b = batch.shim_strengths(kxl_list)
+    if adjust_tunes and (opts.xtune_adjust or opts.ytune_adjust):
+        with stage_timing.stage("adjust_rr60_trim_quads"):
+            (trim_k1, reasons) = batch.adjusted_trim_strengths(b)
+    else:
+        trim_k1 = batch.base_trim_strengths(len(kxl_list))
+        reasons = [None]*len(kxl_list)
+
+    # only the candidates whose tunes could be adjusted are tracked
+    good = [c for c in range(len(kxl_list)) if reasons[c] is None]
+    if good:
+        b_good = b[:, good]
+        trim_good = trim_k1[:, good]
+        coords = batch.initial_coords(batch.one_turn_matrices(b_good, trim_good), dpop_offsets)
+        with stage_timing.stage("batch_tracking"):
+            (tracks, stopped) = batch.track(coords, b_good, trim_good, level['turns'], opts.abort_amplitude)
+        with stage_timing.stage("interp_tunes"):
+            tunes = tune_suite.batch_interp_tunes(tracks.reshape(tracks.shape[0], -1, 2), planes=(0, 1))
+        tunes = tunes.reshape(len(good), len(dpop_offsets), 2)
+
+    results = [None]*len(kxl_list)
+    for c in range(len(kxl_list)):
+        if reasons[c] is not None:
+            results[c] = evaluate.Evaluation(None, None, status='unstable', reason=reasons[c])
+    for g, c in enumerate(good):
+        if stopped[g] is not None:
+            results[c] = evaluate.Evaluation(None, None, turns=level['turns'], status='unstable', reason=stopped[g])
+            continue
+        candidate_tunes = tunes[g]
+        if tracked is not None:
+            candidate_tunes = adaptive_grid.interpolate(grid, tracked, candidate_tunes)
+        results[c] = evaluate.Evaluation(candidate_tunes[:, 0], candidate_tunes[:, 1], turns=level['turns'])
+    for result in results:
+        result.fidelity = fidelity
+    return results
+
+#-----------------------------------------------------------------------
+
+# The tune residual of kxl_values and its Jacobian with respect to the
+# knobs, like evaluate.jacobian(), from one tangent-linear propagation:
+# the derivatives of the survey particles by the knobs are tracked
+# along with them through the derivatives of every piece, and the tune
+# derivatives follow from those of the tracks. Only the linear algebra
+# before the tracking (the trim quad adjustment and the starting orbit)
+# is differenced, with knob steps of step. The turns and tracked
+# offsets follow the fidelity level. Raises RuntimeError if the lattice
+# is unstable.
+
+def tune_jacobian(kxl_values, knobs, adjust_tunes=True, fidelity="full", step=1.0e-6):
+    level = evaluate.get_fidelity_level(fidelity)
+    batch = get_batch_lattice()
+
+    dpop_offsets = rr_tune_survey.get_dpop_offsets()
+    tracked = None
+    if level['offset_step'] > 1:
+        grid = rr_tune_survey.get_freq_offsets()
+        tracked = adaptive_grid.coarse_indices(len(grid), level['offset_step'])
+        dpop_offsets = dpop_offsets[tracked]
+
+    # the point followed by each knob moved up and down by step
+    points = [kxl_values]
+    for knob in knobs:
+        for sign in (1.0, -1.0):
+            point = dict(kxl_values)
+            point[knob] = kxl_values.get(knob, 0.0) + sign*step
+            points.append(point)
+
+    b = batch.shim_strengths(points)
+    if adjust_tunes and (opts.xtune_adjust or opts.ytune_adjust):
+        with stage_timing.stage("adjust_rr60_trim_quads"):
+            (trim_k1, reasons) = batch.adjusted_trim_strengths(b)
+        for point, reason in zip(points, reasons):
+            if reason:
+                raise RuntimeError("tune_jacobian: unstable at {}: {}".format(point, reason))
+    else:
+        trim_k1 = batch.base_trim_strengths(len(points))
+    coords = batch.initial_coords(batch.one_turn_matrices(b, trim_k1), dpop_offsets)
+
+    db = (b[:, 1::2] - b[:, 2::2])/(2.0*step)
+    dk1 = (trim_k1[:, 1::2] - trim_k1[:, 2::2])/(2.0*step)
+    tangents = (coords[1::2] - coords[2::2])/(2.0*step)
+
+    with stage_timing.stage("tangent_tracking"):
+        (tracks, dtracks, reason) = batch.track_tangents(coords[0:1], tangents, b[:, 0:1], db, trim_k1[:, 0:1],
+                                                         dk1, level['turns'], opts.abort_amplitude)
+    if reason:
+        raise RuntimeError("tune_jacobian: unstable at {}: {}".format(kxl_values, reason))
+
+    with stage_timing.stage("interp_tunes"):
+        tunes = tune_suite.batch_interp_tunes(tracks, planes=(0, 1))
+        dtunes = tune_suite.batch_interp_tune_derivatives(tracks, dtracks, planes=(0, 1))
+    if tracked is not None:
+        tunes = adaptive_grid.interpolate(grid, tracked, tunes)
+        dtunes = np.array([adaptive_grid.interpolate(grid, tracked, d) for d in dtunes])
+
+    residual = evaluate.get_residual(evaluate.Evaluation(tunes[:, 0], tunes[:, 1], turns=level['turns']))
+    jac = np.concatenate((dtunes[:, :, 0], dtunes[:, :, 1]), axis=1).T
+    return residual, jac
+
+#-----------------------------------------------------------------------
+
+# Compare the tunes of the batch tracker with evaluate() for the list of
+# kxl_values dicts. Returns a dict with the largest tune differences
+# over the stable candidates and the wall time of both.
+
+def validate_batch(kxl_list, adjust_tunes=True, fidelity="full"):
+    t0 = time.time()
+    batch_results = evaluate_batch(kxl_list, adjust_tunes, fidelity)
+    t1 = time.time()
+    results = [evaluate.evaluate(kxl_values, adjust_tunes=adjust_tunes, fidelity=fidelity) for kxl_values in kxl_list]
+    t2 = time.time()
+
+    dxtunes = [0.0]
+    dytunes = [0.0]
+    agree = 0
+    for batch_result, result in zip(batch_results, results):
+        if batch_result.ok == result.ok:
+            agree = agree + 1
+        if batch_result.ok and result.ok:
+            dxtunes.append(np.max(np.abs(batch_result[0] - result[0])))
+            dytunes.append(np.max(np.abs(batch_result[1] - result[1])))
+
+    return {
+        'candidates': len(kxl_list),
+        'status_agree': agree,
+        'max_dxtune': max(dxtunes),
+        'max_dytune': max(dytunes),
+        'batch_wall': t1 - t0,
+        'evaluate_wall': t2 - t1,
+    }
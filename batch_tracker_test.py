@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("synergia")
+import batch_tracker
+
+# A Batch_lattice without pieces, for the methods that only need their
+# arguments.
+def empty_batch():
+    batch = batch_tracker.Batch_lattice.__new__(batch_tracker.Batch_lattice)
+    batch.pieces = []
+    return batch
+
+# one turn matrices of ncand candidates: a rotation by a different phase
+# in each plane and a random dispersion column
+def one_turn_matrices(ncand, rng):
+    matrices = np.tile(np.identity(5), (ncand, 1, 1))
+    for c in range(ncand):
+        for (u, phase) in ((0, 2*np.pi*(0.40 + 0.01*c)), (2, 2*np.pi*(0.37 - 0.01*c))):
+            matrices[c, u:u+2, u:u+2] = [[np.cos(phase), 8.0*np.sin(phase)], [-np.sin(phase)/8.0, np.cos(phase)]]
+        matrices[c, 0:4, 4] = rng.normal(size=4)
+    return matrices
+
+def test_initial_coords_on_dispersion_orbit():
+    rng = np.random.default_rng(1)
+    dpop_offsets = np.array([-2.0e-3, 0.0, 1.0e-3, 3.0e-3])
+    matrices = one_turn_matrices(3, rng)
+
+    coords = empty_batch().initial_coords(matrices, dpop_offsets)
+
+    assert coords.shape == (3, len(dpop_offsets), 6)
+    np.testing.assert_array_equal(coords[:, :, 5], np.broadcast_to(dpop_offsets, (3, len(dpop_offsets))))
+    for c in range(3):
+        for p in np.nonzero(dpop_offsets)[0]:
+            orbit = coords[c, p, [0, 1, 2, 3, 5]]
+            np.testing.assert_allclose(matrices[c] @ orbit, orbit, atol=1.0e-15)
+    np.testing.assert_array_equal(coords[:, 1, [0, 2]], 1.0e-7)
+
+def test_track_stop_reason_without_abort_amplitude():
+    coords = np.zeros((2, 3, 6))
+    coords[1, 2, 0] = np.inf
+    batch = empty_batch()
+
+    (tracks, reasons) = batch.track(coords.copy(), None, None, 4)
+
+    assert reasons[0] is None
+    assert "not finite" in reasons[1] and "None" not in reasons[1]
+    (tracks, reasons) = batch.track(coords.copy(), None, None, 4, abort_amplitude=0.05)
+    assert "beyond 0.05" in reasons[1]
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+import numpy as np
+import synergia
+
+import evaluate
+import rr_tune_survey
+import stage_timing
+from rr_options import opts
+
+# Dynamic aperture of a lattice by bisection along rays.
+#
+# At each momentum offset rays are launched in the (x, y) plane from the
+# dispersion orbit, at angles from the x axis to the y axis. For every
+# ray the stable amplitude is bracketed between the largest amplitude
+# that survived and the smallest that was lost, starting from 0 and
+# da_max_amplitude. Every round tracks one particle per unfinished ray,
+# all in one bunch, for da_turns turns at the middle of its bracket and
+# halves the bracket. The lattice gets a circular aperture of opts.radius
+# on every element, so synergia drops a lost particle from the bunch at
+# once and no more work goes into it. A ray that survives at
+# da_max_amplitude is finished after the first round.
+#
+#    mpirun -np 4 python dynamic_aperture.py --da_rays=9 --da_bisections=7
+
+#-----------------------------------------------------------------------
+
+# a copy of lattice with a circular aperture of radius on every element
+def get_aperture_lattice(lattice, radius):
+    aperture_lattice = synergia.lattice.Lattice.load_from_json(lattice.as_json())
+    aperture_lattice.set_all_string_attribute("aperture_type", "circular")
+    aperture_lattice.set_all_double_attribute("circular_aperture_radius", radius)
+    return aperture_lattice
+
+# the ray angles from the x axis to the y axis
+def get_ray_angles(nrays):
+    return np.linspace(0.0, 0.5*np.pi, nrays)
+
+#-----------------------------------------------------------------------
+
+# Find the dynamic aperture of lattice at the momentum offsets
+# dpop_offsets. Returns a dict with the offsets, the ray angles, the
+# largest stable amplitude along every ray, shape (offsets, rays), the
+# bracket width left, the area inside the boundary of each offset in the
+# x > 0, y > 0 quadrant and the particles and rounds tracked.
+
+def dynamic_aperture(lattice, dpop_offsets, nrays, max_amplitude, bisections, turns):
+    aperture_lattice = get_aperture_lattice(lattice, opts.radius)
+    angles = get_ray_angles(nrays)
+    orbits = rr_tune_survey.get_initial_coords(aperture_lattice, np.asarray(dpop_offsets, dtype='d'))
+    orbits = np.repeat(orbits, nrays, axis=0)
+    directions = np.tile(np.column_stack((np.cos(angles), np.sin(angles))), (len(dpop_offsets), 1))
+
+    stable = np.zeros(len(orbits))
+    unstable = np.full(len(orbits), max_amplitude)
+    trial = np.full(len(orbits), max_amplitude)
+    active = np.arange(len(orbits))
+    particles = 0
+    rounds = 0
+
+    for bisection in range(bisections + 1):
+        if len(active) == 0:
+            break
+        coords = orbits[active].copy()
+        coords[:, 0] += trial[active]*directions[active, 0]
+        coords[:, 2] += trial[active]*directions[active, 1]
+
+        with stage_timing.stage("da_tracking"):
+            tracks = rr_tune_survey.run_rr(aperture_lattice, turns, coords=coords)
+        survived = tracks.get_last_turns() == turns
+        particles = particles + len(active)
+        rounds = rounds + 1
+
+        stable[active[survived]] = trial[active[survived]]
+        unstable[active[np.logical_not(survived)]] = trial[active[np.logical_not(survived)]]
+        if bisection == 0:
+            # rays stable out to max_amplitude are finished
+            active = active[np.logical_not(survived)]
+        trial = 0.5*(stable + unstable)
+
+    amplitudes = stable.reshape(len(dpop_offsets), nrays)
+    stage_timing.count("particles", particles)
+    return {
+        'dpop_offsets': np.asarray(dpop_offsets, dtype='d'),
+        'angles': angles,
+        'amplitudes': amplitudes,
+        'resolution': np.max(unstable - stable),
+        'area': get_areas(angles, amplitudes),
+        'particles': particles,
+        'rounds': rounds,
+    }
+
+# the area inside the boundary through the amplitudes along the rays at
+# angles, for each row of amplitudes, from the triangles between
+# neighbouring rays
+def get_areas(angles, amplitudes):
+    return 0.5*np.sum(amplitudes[:, :-1]*amplitudes[:, 1:]*np.sin(np.diff(angles)), axis=1)
+
+#-----------------------------------------------------------------------
+
+# The dynamic aperture of the lattice of kxl_values with the da_ options.
+# The smallest area over the momentum offsets, result['area'].min(), is
+# a single aperture figure for an optimizer objective.
+
+def evaluate_da(kxl_values, adjust_tunes=True):
+    lattice = evaluate.generate_lattice(kxl_values, adjust_tunes=adjust_tunes)
+    return dynamic_aperture(lattice, opts.da_dpop_offsets, opts.da_rays, opts.da_max_amplitude,
+                            opts.da_bisections, opts.da_turns)
+
+def main():
+    result = evaluate_da({})
+    if rr_tune_survey.survey_comm.Get_rank() == 0:
+        np.savez(opts.da_file, **result)
+        for dpop, amplitudes, area in zip(result['dpop_offsets'], result['amplitudes'], result['area']):
+            print("dp/p ", dpop, " area ", area, " amplitudes ", amplitudes)
+        print("dynamic aperture from ", result['particles'], " particles in ", result['rounds'],
+              " rounds, saved to ", opts.da_file)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+
+import os
+import time
+import ipaddress
+import threading
+import concurrent.futures
+import concurrent.futures.process
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+
+import numpy as np
+
+import evaluate
+from rr_options import opts
+
+# Long-running local evaluation service for external optimizers.
+#
+# The server keeps the evaluate_many() pool of warm worker processes,
+# so the synergia import and template parsing are paid once per worker
+# rather than once per point. Clients connect over a Unix socket, or
+# a loopback TCP port when the address is "host:port", and exchange dicts
+# with an "op" key:
+#
+#    {"op": "submit", "kxl_list": [...], "adjust_tunes": True, "mode": "track", "fidelity": "full"}
+#        -> {"op": "accepted", "job": id, "count": n}
+#        -> {"op": "result", "job": id, "index": i, ...} as each finishes
+#        -> {"op": "done", "job": id}
+#    {"op": "cancel", "job": id}  -> {"op": "cancelled", "job": id, "count": n}
+#    {"op": "status"}             -> {"op": "status", "workers": n, "jobs": {...}}
+#    a request that fails          -> {"op": "error", "reason": ...}
+#
+# Cancelling drops the points of the job that have not started; the
+# points already running finish and are reported. Use Eval_client from
+# Python rather than speaking the protocol directly.
+#
+# Messages are pickled, so whoever can connect can run code as the
+# server user. The server only listens on a Unix socket, made readable
+# by its owner only, or on the loopback interface, and a connection has
+# to pass the multiprocessing.connection challenge on an authkey. The
+# key is taken from the environment variable RR_EVAL_AUTHKEY, or else a
+# random one is made for each server and written to the key file
+# get_authkey_file(address), readable by its owner only. The client
+# reads the key from the same places.
+
+authkey_variable = "RR_EVAL_AUTHKEY"
+
+# A Unix socket path, or a (host, port) tuple for "host:port". TCP is
+# only served on the loopback interface: an empty host or localhost is
+# 127.0.0.1 and other hosts are refused.
+def parse_address(address):
+    if ':' not in address:
+        return address
+    (host, port) = address.rsplit(':', 1)
+    if host in ("", "localhost"):
+        host = "127.0.0.1"
+    try:
+        loopback = ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        loopback = False
+    if not loopback:
+        raise RuntimeError("eval_server: {} is not a loopback address, use 127.0.0.1:{} or a Unix socket".format(
+            host, port))
+    return (host, int(port))
+
+# the file holding the authkey of the server at address
+def get_authkey_file(address):
+    address = parse_address(address)
+    if isinstance(address, str):
+        return address + ".key"
+    return "rr_eval_{}.key".format(address[1])
+
+# The authkey from RR_EVAL_AUTHKEY if it is set. Otherwise, for a
+# server (create=True) a new random key written to key_file, and for a
+# client the key read from key_file.
+def get_authkey(key_file, create=False):
+    if os.environ.get(authkey_variable):
+        return os.environ[authkey_variable].encode()
+    if create:
+        authkey = os.urandom(32).hex().encode()
+        if os.path.exists(key_file):
+            os.remove(key_file)
+        fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(authkey)
+        return authkey
+    try:
+        with open(key_file, 'rb') as f:
+            return f.read().strip()
+    except OSError:
+        raise RuntimeError("eval_server: no authkey, set {} or check that the server wrote {}".format(
+            authkey_variable, key_file))
+
+#-----------------------------------------------------------------------
+
+# the message for the finished future of point index of job
+def result_message(job_id, index, future):
+    message = {'op': 'result', 'job': job_id, 'index': index}
+    if future.cancelled():
+        message['status'] = 'cancelled'
+        return message
+    e = future.exception()
+    if e is not None:
+        message['status'] = 'error'
+        message['reason'] = str(e)
+        return message
+
+    result = future.result()
+    message['status'] = result.status
+    message['reason'] = result.reason
+    message['turns'] = result.turns
+    message['stats'] = result.stats
+    message['fidelity'] = result.fidelity
+    if result.ok:
+        message['xtunes'] = np.asarray(result[0]).tolist()
+        message['ytunes'] = np.asarray(result[1]).tolist()
+    return message
+
+#-----------------------------------------------------------------------
+
+class Job:
+    def __init__(self, job_id, futures):
+        self.job_id = job_id
+        self.futures = futures
+        self.submitted = time.time()
+
+    def status(self):
+        done = sum(1 for f in self.futures if f.done() and not f.cancelled())
+        cancelled = sum(1 for f in self.futures if f.cancelled())
+        running = sum(1 for f in self.futures if f.running())
+        return {
+            'count': len(self.futures),
+            'done': done,
+            'running': running,
+            'pending': len(self.futures) - done - cancelled - running,
+            'cancelled': cancelled,
+            'submitted': self.submitted,
+        }
+
+#-----------------------------------------------------------------------
+
+class Eval_server:
+    def __init__(self, address, workers=None, authkey=None):
+        self.address = parse_address(address)
+        self.key_file = get_authkey_file(address)
+        self.workers = workers
+        self.authkey = authkey
+        self.jobs = {}
+        self.next_job = 0
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+
+    def serve_forever(self):
+        evaluate.get_worker_pool(self.workers)
+        self.workers = evaluate.worker_pool_size
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            # left over from a server that did not shut down cleanly
+            os.remove(self.address)
+        if self.authkey is None:
+            self.authkey = get_authkey(self.key_file, create=True)
+        with Listener(self.address, authkey=self.authkey) as listener:
+            if isinstance(self.address, str):
+                os.chmod(self.address, 0o600)
+            print("eval_server: listening on ", listener.address, " with ", self.workers, " workers", flush=True)
+            while True:
+                try:
+                    conn = listener.accept()
+                except (AuthenticationError, OSError, EOFError) as e:
+                    # a client that failed authentication
+                    print("eval_server: rejected connection: ", e, flush=True)
+                    continue
+                threading.Thread(target=self.handle_connection, args=(conn,), daemon=True).start()
+
+    def handle_connection(self, conn):
+        send_lock = threading.Lock()
+
+        def send(message):
+            with send_lock:
+                conn.send(message)
+
+        try:
+            while True:
+                try:
+                    message = conn.recv()
+                except EOFError:
+                    break
+                try:
+                    self.handle_message(message, send)
+                except OSError:
+                    raise
+                except Exception as e:
+                    # a bad request or a pool that could not be started,
+                    # the server carries on
+                    send({'op': 'error', 'reason': "{}: {}".format(type(e).__name__, e)})
+        except OSError:
+            # the client went away
+            pass
+        finally:
+            conn.close()
+
+    def handle_message(self, message, send):
+        op = message.get('op') if isinstance(message, dict) else None
+        if op == 'submit':
+            job = self.submit(message['kxl_list'], message.get('adjust_tunes', True),
+                              message.get('mode', "track"), message.get('fidelity', "full"))
+            send({'op': 'accepted', 'job': job.job_id, 'count': len(job.futures)})
+            threading.Thread(target=self.stream_results, args=(job, send), daemon=True).start()
+        elif op == 'cancel':
+            send({'op': 'cancelled', 'job': message['job'], 'count': self.cancel(message['job'])})
+        elif op == 'status':
+            send(self.status())
+        else:
+            send({'op': 'error', 'reason': "unknown op: {}".format(op)})
+
+    def submit(self, kxl_list, adjust_tunes, mode, fidelity):
+        try:
+            futures = self.submit_points(kxl_list, adjust_tunes, mode, fidelity)
+        except concurrent.futures.process.BrokenProcessPool:
+            # a worker died during an earlier job, which breaks the
+            # pool for good, so start a new one
+            evaluate.shutdown_worker_pool()
+            futures = self.submit_points(kxl_list, adjust_tunes, mode, fidelity)
+        with self.lock:
+            job = Job(self.next_job, futures)
+            self.jobs[job.job_id] = job
+            self.next_job = self.next_job + 1
+        return job
+
+    def submit_points(self, kxl_list, adjust_tunes, mode, fidelity):
+        pool = evaluate.get_worker_pool(self.workers)
+        return [pool.submit(evaluate.evaluate, kxl_values, False, adjust_tunes, mode, fidelity)
+                for kxl_values in kxl_list]
+
+    # send the results of job in the order they finish, then forget it
+    def stream_results(self, job, send):
+        index = {f: k for k, f in enumerate(job.futures)}
+        try:
+            for f in concurrent.futures.as_completed(job.futures):
+                send(result_message(job.job_id, index[f], f))
+            send({'op': 'done', 'job': job.job_id})
+        except OSError:
+            # the client went away, so its remaining points are not wanted
+            self.cancel(job.job_id)
+        finally:
+            with self.lock:
+                self.jobs.pop(job.job_id, None)
+
+    # Returns the number of points that will not be evaluated
+    def cancel(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            return 0
+        return sum(1 for f in job.futures if f.cancel())
+
+    def status(self):
+        with self.lock:
+            jobs = {job_id: job.status() for job_id, job in self.jobs.items()}
+        return {'op': 'status', 'workers': self.workers, 'uptime': time.time() - self.start_time, 'jobs': jobs}
+
+#-----------------------------------------------------------------------
+
+# Client side of the protocol. Several jobs can be outstanding on one
+# connection; messages for other jobs are held until asked for. An error
+# reply from the server is raised as RuntimeError.
+
+class Eval_client:
+    def __init__(self, address, authkey=None):
+        if authkey is None:
+            authkey = get_authkey(get_authkey_file(address))
+        self.conn = Client(parse_address(address), authkey=authkey)
+        self.held = []
+
+    def close(self):
+        self.conn.close()
+
+    # the next message satisfying match, holding on to the others
+    def receive(self, match):
+        for k, message in enumerate(self.held):
+            if match(message):
+                return self.held.pop(k)
+        while True:
+            message = self.conn.recv()
+            if message['op'] == 'error':
+                raise RuntimeError("eval_server: {}".format(message['reason']))
+            if match(message):
+                return message
+            self.held.append(message)
+
+    # returns the job id
+    def submit(self, kxl_list, adjust_tunes=True, mode="track", fidelity="full"):
+        self.conn.send({'op': 'submit', 'kxl_list': list(kxl_list), 'adjust_tunes': adjust_tunes, 'mode': mode,
+                        'fidelity': fidelity})
+        return self.receive(lambda m: m['op'] == 'accepted')['job']
+
+    # yield the result messages of job as they arrive
+    def results(self, job_id):
+        while True:
+            message = self.receive(lambda m: m.get('job') == job_id and m['op'] in ('result', 'done'))
+            if message['op'] == 'done':
+                return
+            yield message
+
+    def cancel(self, job_id):
+        self.conn.send({'op': 'cancel', 'job': job_id})
+        return self.receive(lambda m: m['op'] == 'cancelled' and m['job'] == job_id)['count']
+
+    def status(self):
+        self.conn.send({'op': 'status'})
+        return self.receive(lambda m: m['op'] == 'status')
+
+    # submit kxl_list and wait for all of it, returning the result
+    # messages in the order of kxl_list
+    def evaluate_batch(self, kxl_list, adjust_tunes=True, mode="track", fidelity="full"):
+        job_id = self.submit(kxl_list, adjust_tunes, mode, fidelity)
+        results = [None]*len(kxl_list)
+        for message in self.results(job_id):
+            results[message['index']] = message
+        return results
+
+#-----------------------------------------------------------------------
+
+def main():
+    Eval_server(opts.server_address, opts.server_workers).serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,25 @@
 #!/usr/bin/env python
 #
 
+import os
+import gc
+import atexit
+import tempfile
+import multiprocessing
+import concurrent.futures
+import concurrent.futures.process
+
 import synergia
 import rr_tune_survey
 import rr_setup
 from rr_options import opts
 import rrnova_qt60x
 import tune_suite
+import taylor_map
+import reduced_lattice
+import adaptive_grid
+import result_cache
+import stage_timing
 import h5py
 import numpy as np
 
@@ -16,6 +29,20 @@ RR_template_file = "RR2020V0922_TEMPLATE_fixed"
 #RR_template_file = "RR2020V0922FLAT_fixed"
 RR_ring_name = "ring605_fodo"
 
+# measured tunes vs frequency offset
+tune_data_file = "tunefreq_fine.txt"
+
+# options that the evaluate_many() worker processes copy from the
+# process that started them
+worker_opts = ("turns", "xtune_adjust", "ytune_adjust", "rf_voltage", "start_element",
+               "lattice_simplify", "min_freq_offset", "max_freq_offset", "freq_offset_step",
+               "tracks_file", "cache_dir", "cache_max_mb", "converge_tol", "check_period",
+               "converge_checks", "prescreen", "prescreen_tol", "abort_amplitude", "abort_period",
+               "tracking_engine", "map_order", "checkpoint", "checkpoint_period", "checkpoint_max_turns", "scratch",
+               "reuse_buffers", "gc_period", "stats_file", "reduced_chromatic_order", "adaptive_step",
+               "adaptive_tol", "adaptive_residual_tol", "adaptive_rounds", "map_mode_tol", "norm_emit", "stdz",
+               "xchrom_adjust", "ychrom_adjust")
+
 
 """
    Given input dict with parameters { 'kxl_even': xxx , ... 
@@ -29,23 +56,54 @@ RR_ring_name = "ring605_fodo"
 
 #----------------------------------------------------------------------
 
-def generate_lattice(kxl_values, adjust_tunes=True):
-    lattice = rr_tune_survey.get_rr_lattice_for_opt(RR_template_file, RR_ring_name, kxl_values)
+# The template lattice is parsed, reordered, converted and marked for
+# simplification only once. The result is cached as a Knob_bound_lattice
+# that only has to set the knob dependent MPS*U strengths for each
+# evaluation. The cache is redone if the template file or the options
+# used in preparing it change.
 
+knob_lattices = {}
+
+def prepare_template_lattice(lattice):
     #  replacing old rr_setup.setup() do-it-all,
     if opts.start_element:
         lattice_tmp1 = rr_setup.reorder_lattice(lattice, opts.start_element)
     else:
         lattice_tmp1 = lattice
 
-    lattice_tmp1a = rr_setup.convert_rbends_to_sbends(lattice_tmp1)
+    with stage_timing.stage("convert_rbends_to_sbends"):
+        lattice_tmp1a = rr_setup.convert_rbends_to_sbends(lattice_tmp1)
 
     if opts.lattice_simplify:
         lattice_tmp2 = rr_setup.keep_qt(lattice_tmp1a)
     else:
         lattice_tmp2 = lattice_tmp1a
 
-    (xtune, ytune, cdt) = synergia.simulation.Lattice_simulator.calculate_tune_and_cdt(lattice_tmp2)
+    return lattice_tmp2
+
+def get_knob_bound_lattice():
+    template_file = os.path.abspath(RR_template_file)
+    key = (template_file, os.path.getmtime(template_file), RR_ring_name,
+           opts.start_element, opts.lattice_simplify)
+    if key not in knob_lattices:
+        with stage_timing.stage("template_parse"):
+            with open(template_file, 'r') as f:
+                template = f.read()
+            lattice = rr_tune_survey.parse_rr_template(template, RR_ring_name, {})
+            knob_elements = rr_tune_survey.get_knob_elements(template)
+        knob_lattices.clear()
+        knob_lattices[key] = rr_tune_survey.Knob_bound_lattice(prepare_template_lattice(lattice), knob_elements)
+    return knob_lattices[key]
+
+#----------------------------------------------------------------------
+
+def generate_lattice(kxl_values, adjust_tunes=True):
+    knob_lattice = get_knob_bound_lattice()
+    with stage_timing.stage("bind_knobs"):
+        lattice_tmp2 = knob_lattice.get_lattice(kxl_values)
+
+    with stage_timing.stage("calculate_tune_and_cdt"):
+        (xtune, ytune, cdt) = synergia.simulation.Lattice_simulator.calculate_tune_and_cdt(lattice_tmp2)
 
     print('generate_lattice, initial xtune: ', xtune, ', ytune: ', ytune)
 
@@ -65,7 +123,8 @@ def generate_lattice(kxl_values, adjust_tunes=True):
         else:
             delta_ytune = 0.0
 
-        rrnova_qt60x.adjust_rr60_trim_quads(lattice_tmp2, delta_xtune, delta_ytune)
+        with stage_timing.stage("adjust_rr60_trim_quads"):
+            rrnova_qt60x.adjust_rr60_trim_quads(lattice_tmp2, delta_xtune, delta_ytune)
 
     else:
         print('skipping tune adjustment')
@@ -77,7 +136,8 @@ def generate_lattice(kxl_values, adjust_tunes=True):
     # cavities in lattice_tmp2 are modified in-place
     rr_setup.setup_rf_cavities(lattice_tmp2, opts.rf_voltage, harmno)
 
-    synergia.simulation.Lattice_simulator.tune_circular_lattice(lattice_tmp2)
+    with stage_timing.stage("tune_circular_lattice"):
+        synergia.simulation.Lattice_simulator.tune_circular_lattice(lattice_tmp2)
 
     return lattice_tmp2
 
@@ -90,40 +150,445 @@ def save_lattice_txt(lattice, filename):
 
 #----------------------------------------------------------------------
 
-def run_particles(lattice):
+# Returns the Track_buffer with the tracks. With opts.tracking_engine
+# "map" the particles are tracked with a one-turn polynomial map of
+# order opts.map_order instead of element by element, with "reduced"
+# through the reduced lattice of reduced_lattice. The particles
+# start at coords if given, otherwise at the survey offsets, and are
+# tracked for turns turns, by default opts.turns. With abort false the
+# survey does not stop at opts.abort_amplitude. With reuse_tracks true
+# and opts.reuse_buffers set, element tracking returns the shared
+# Track_buffer of rr_tune_survey.get_track_buffer(), which the next
+# survey overwrites, so only callers that are done with the tracks
+# before tracking again should ask for it.
+def run_particles(lattice, coords=None, turns=None, abort=True, reuse_tracks=False):
     # We're only  going to propagate a small number of particles
     # each at a different momentum to determine their tunes so I
     # don't really need the grid stuff.
 
-    rr_tune_survey.run_rr(lattice, opts.turns)
+    if turns is None:
+        turns = opts.turns
+    abort_amplitude = opts.abort_amplitude if abort else None
+
+    if opts.tracking_engine == "map":
+        with stage_timing.stage("map_tracking"):
+            return taylor_map.run_map(lattice, turns, opts.map_order,
+                                      abort_amplitude=abort_amplitude, coords=coords)
+    elif opts.tracking_engine == "reduced":
+        with stage_timing.stage("reduced_tracking"):
+            return reduced_lattice.run_reduced(lattice, turns, opts.reduced_chromatic_order, opts.map_order,
+                                               abort_amplitude=abort_amplitude, coords=coords)
+    elif opts.tracking_engine != "elements":
+        raise RuntimeError("unknown tracking_engine: {}".format(opts.tracking_engine))
+
+    if opts.checkpoint:
+        checkpoint_dir = os.path.join(opts.scratch or ".", "checkpoint")
+    else:
+        checkpoint_dir = None
+
+    tracks = rr_tune_survey.run_rr(lattice, turns, tracks_file=opts.tracks_file,
+                                   converge_tol=opts.converge_tol, check_period=opts.check_period,
+                                   converge_checks=opts.converge_checks,
+                                   abort_amplitude=abort_amplitude, abort_period=opts.abort_period,
+                                   checkpoint_dir=checkpoint_dir, checkpoint_period=opts.checkpoint_period,
+                                   coords=coords, reuse_tracks=reuse_tracks and opts.reuse_buffers,
+                                   max_turns=opts.checkpoint_max_turns if checkpoint_dir else None)
+    return tracks
+
+#----------------------------------------------------------------------
+
+# read the tracks saved by a run with opts.tracks_file set
+def read_tracks(filename='tracks.h5'):
+    with stage_timing.stage("hdf5_io"):
+        with h5py.File(filename, 'r') as h5:
+            trks = h5.get('track_coords')[()]
+    return trks[:, :, 0:6]
+
+#----------------------------------------------------------------------
+
+# the measured x and y tunes interpolated onto the frequency offsets
+# of the survey, as an array of shape (offsets, 2)
+def get_measured_tunes():
+    data = np.loadtxt(tune_data_file, skiprows=1, delimiter=",")
+    freqs = rr_tune_survey.get_freq_offsets()
+    return np.column_stack((np.interp(freqs, data[:, 0], data[:, 1]),
+                            np.interp(freqs, data[:, 0], data[:, 2])))
+
+#----------------------------------------------------------------------
+
+# calculate the x and y tunes for each particle from the
+# tracks trks with shape (turns+1, particles, 6). method "interp" is
+# the interpolated FFT peak, "refined" the slower but more precise
+# tune_suite.refined_tunes().
+def analyze_propagation(trks, method="interp"):
+    if method == "interp":
+        with stage_timing.stage("interp_tunes"):
+            tunes = tune_suite.batch_interp_tunes(trks)
+    elif method == "refined":
+        with stage_timing.stage("refined_tunes"):
+            tunes = np.array([tune_suite.refined_tunes(trks[:, k, :].T)[0:2] for k in range(trks.shape[1])])
+    else:
+        raise RuntimeError("unknown tune analysis method: {}".format(method))
+    return tunes[:, 0], tunes[:, 1]
+
+#----------------------------------------------------------------------
+
+# Fidelity levels of evaluate(). Each gives the turns to track (None
+# for opts.turns), the step between the tracked survey offsets (the
+# tunes are interpolated onto the others) and the tune analysis method
+# of analyze_propagation(). A level costs roughly turns/opts.turns
+# divided by offset_step of a full evaluation, plus the lattice setup.
+
+fidelity_levels = {
+    "coarse": {'turns': 256, 'offset_step': 4, 'analysis': "interp"},
+    "medium": {'turns': 512, 'offset_step': 2, 'analysis': "interp"},
+    "full": {'turns': None, 'offset_step': 1, 'analysis': "interp"},
+}
+
+# the settings of fidelity level name with the turns filled in
+def get_fidelity_level(name):
+    if name not in fidelity_levels:
+        raise RuntimeError("unknown fidelity level: {}".format(name))
+    level = dict(fidelity_levels[name])
+    if level['turns'] is None:
+        level['turns'] = opts.turns
+    return level
+
+# A fidelity level for an optimizer with trust region radius, starting
+# from initial_radius: coarse while the region is large, full once it
+# has shrunk to a tenth.
+def fidelity_for_radius(radius, initial_radius):
+    if radius > 0.5*initial_radius:
+        return "coarse"
+    if radius > 0.1*initial_radius:
+        return "medium"
+    return "full"
+
+#----------------------------------------------------------------------
+
+# The result of evaluate(). It unpacks as (xtunes, ytunes) and also
+# records how many turns were propagated. When the lattice could not be
+# evaluated, status is 'unstable', the tunes are None and reason says
+# what went wrong. A checkpointed survey stopped at
+# opts.checkpoint_max_turns has status 'incomplete'. stats is the stage_timing record of the evaluation
+# and fidelity the fidelity level it was done at.
+
+class Evaluation(tuple):
+    def __new__(cls, xtunes, ytunes, turns=None, status='ok', reason=None):
+        result = tuple.__new__(cls, (xtunes, ytunes))
+        result.turns = turns
+        result.status = status
+        result.reason = reason
+        result.stats = None
+        result.fidelity = None
+        return result
+
+    @property
+    def ok(self):
+        return self.status == 'ok'
+
+    def __getnewargs__(self):
+        return (self[0], self[1])
+
+# the Evaluation of a checkpointed survey stopped after turns turns
+def interrupted_evaluation(turns):
+    return Evaluation(None, None, turns=turns, status='incomplete',
+                      reason="stopped at turn {} of {}, run again to continue from the checkpoint".format(
+                          turns, opts.turns))
+
+#----------------------------------------------------------------------
+
+# Results of evaluate() are kept in the on-disk cache opts.cache_dir
+# if it is set. The key covers everything the result depends on, and
+# unstable lattices are cached too. One Result_cache is kept per
+# directory and size so its running size estimate carries over from one
+# evaluation to the next.
+
+result_caches = {}
+
+def get_result_cache():
+    if not opts.cache_dir:
+        return None
+    key = (opts.cache_dir, opts.cache_max_mb)
+    if key not in result_caches:
+        result_caches[key] = result_cache.Result_cache(opts.cache_dir, opts.cache_max_mb*1024*1024)
+    return result_caches[key]
+
+def get_knob_vector(kxl_values):
+    return np.array([kxl_values.get(knob, 0) for knob in rr_tune_survey.knob_names], dtype='d')
+
+def evaluation_key(kxl_values, adjust_tunes, mode="track", fidelity="full"):
+    inputs = {
+        'mode': mode,
+        'fidelity': get_fidelity_level(fidelity),
+        'kxl': get_knob_vector(kxl_values).tolist(),
+        'template': result_cache.file_digest(RR_template_file),
+        'ring': RR_ring_name,
+        'start_element': opts.start_element,
+        'lattice_simplify': opts.lattice_simplify,
+        'turns': opts.turns,
+        'dpop_offsets': rr_tune_survey.get_dpop_offsets().tolist(),
+        'adjust_tunes': adjust_tunes,
+        'xtune_adjust': opts.xtune_adjust,
+        'ytune_adjust': opts.ytune_adjust,
+        'rf_voltage': opts.rf_voltage,
+        'converge_tol': opts.converge_tol,
+        'check_period': opts.check_period,
+        'converge_checks': opts.converge_checks,
+        'prescreen': opts.prescreen,
+        'prescreen_tol': opts.prescreen_tol,
+        'abort_amplitude': opts.abort_amplitude,
+        'abort_period': opts.abort_period,
+        'tracking_engine': opts.tracking_engine,
+        'map_order': opts.map_order if opts.tracking_engine in ("map", "reduced") else None,
+        'reduced_chromatic_order': opts.reduced_chromatic_order if opts.tracking_engine == "reduced" else None,
+    }
+    if mode == "adaptive":
+        inputs['adaptive'] = (opts.adaptive_step, opts.adaptive_tol, opts.adaptive_residual_tol,
+                              opts.adaptive_rounds, result_cache.file_digest(tune_data_file))
+    return result_cache.make_key(inputs)
+
+#----------------------------------------------------------------------
+
+# With mode "track" (the default) the tunes come from tracking the
+# survey particles. With mode "map" no particles are tracked: the tunes
+# at each momentum offset are the eigentunes of the linear one turn map
+# about the off-momentum closed orbit (see evaluate_map_mode()). With
+# mode "adaptive" only some of the offsets are tracked and the tunes
+# are interpolated onto the rest (see evaluate_adaptive()).
+#
+# fidelity names one of fidelity_levels. The tracking modes use its
+# turns and tune analysis method, and mode "track" its offset step.
+#
+# Every evaluation records the wall and CPU time of its stages, the
+# particle and turn counts, the peak RSS and the RSS growth in
+# result.stats. The record is also appended to the JSON-lines file
+# opts.stats_file if it is set. Every opts.gc_period evaluations the
+# garbage collector is run at the end of the evaluation.
+
+evaluation_count = 0
+
+def evaluate(kxl_values, chatty=False, adjust_tunes=True, mode="track", fidelity="full"):
+    global evaluation_count
+    with stage_timing.recording() as record:
+        result = evaluate_with_cache(kxl_values, chatty, adjust_tunes, mode, fidelity)
+        evaluation_count = evaluation_count + 1
+        if opts.gc_period and evaluation_count % opts.gc_period == 0:
+            with stage_timing.stage("gc"):
+                gc.collect()
+
+    stats = record.as_dict()
+    stats['kxl'] = get_knob_vector(kxl_values).tolist()
+    stats['mode'] = mode
+    stats['fidelity'] = fidelity
+    stats['status'] = result.status
+    result.stats = stats
+    result.fidelity = fidelity
+
+    if opts.stats_file and rr_tune_survey.survey_comm.Get_rank() == 0:
+        stage_timing.append_jsonl(opts.stats_file, stats)
+    if chatty:
+        print("evaluate: {:.3f} s wall, {:.3f} s cpu, peak RSS {:.1f} MB".format(
+            stats['wall'], stats['cpu'], stats['peak_rss_mb']))
+
+    return result
+
+#----------------------------------------------------------------------
+
+def evaluate_with_cache(kxl_values, chatty=False, adjust_tunes=True, mode="track", fidelity="full"):
+    cache = get_result_cache()
+    if cache is None:
+        return evaluate_uncached(kxl_values, chatty, adjust_tunes, mode, fidelity)
+
+    # All the ranks have to take the same branch, so rank 0 decides
+    # whether there is a cached result and writes new ones.
+    comm = rr_tune_survey.survey_comm
+    key = evaluation_key(kxl_values, adjust_tunes, mode, fidelity)
+    entry = None
+    if comm.Get_rank() == 0:
+        entry = cache.get(key)
+    if comm.Get_size() > 1:
+        entry = comm.bcast(entry, root=0)
+    if entry is not None:
+        stage_timing.count("cache_hit", 1)
+        if chatty:
+            print("evaluate: using cached result ", key)
+        return cached_evaluation(entry)
+
+    result = evaluate_uncached(kxl_values, chatty, adjust_tunes, mode, fidelity)
+    if comm.Get_rank() == 0:
+        store_evaluation(cache, key, kxl_values, result, adjust_tunes, mode, fidelity)
+    return result
+
+# the Evaluation of a result cache entry
+def cached_evaluation(entry):
+    if entry['status'] != 'ok':
+        return Evaluation(None, None, status=entry['status'], reason=entry['reason'])
+    turns = int(entry['turns']) if 'turns' in entry else None
+    return Evaluation(entry['xtunes'], entry['ytunes'], turns=turns)
+
+# Store result under key. Besides the result, the entry records the knob
+# vector and the settings of the evaluation, for readers of the cache
+# such as the surrogate model. Incomplete results are not stored.
+def store_evaluation(cache, key, kxl_values, result, adjust_tunes, mode, fidelity):
+    if result.status == 'incomplete':
+        return
+    entry = dict(status=result.status, kxl=get_knob_vector(kxl_values), adjust_tunes=adjust_tunes, mode=mode,
+                 fidelity=fidelity)
+    if result.ok:
+        entry['xtunes'] = result[0]
+        entry['ytunes'] = result[1]
+        if result.turns is not None:
+            entry['turns'] = result.turns
+    else:
+        entry['reason'] = result.reason
+    cache.put(key, **entry)
+
+#----------------------------------------------------------------------
+
+# Check that the lattice can be tracked at the extreme momentum offsets
+# of the survey: the closed orbit has to exist and the transverse one
+# turn map may not have eigenvalues outside the unit circle.
+# Returns None if the lattice passes, otherwise the reason it fails.
+
+def prescreen_lattice(lattice):
+    dpop_offsets = rr_tune_survey.get_dpop_offsets()
+    SIM = synergia.simulation
+    for dpop in (dpop_offsets[0], dpop_offsets[-1]):
+        try:
+            SIM.Lattice_simulator.calculate_closed_orbit(lattice, dpop)
+        except Exception as e:
+            return "no closed orbit at dp/p {}: {}".format(dpop, e)
+
+        try:
+            one_turn_map = SIM.Lattice_simulator.get_linear_one_turn_map(lattice, dpop)
+        except Exception as e:
+            return "no one turn map at dp/p {}: {}".format(dpop, e)
+
+        moduli = np.abs(np.linalg.eigvals(np.array(one_turn_map)[0:4, 0:4]))
+        if not np.all(moduli <= 1.0 + opts.prescreen_tol):
+            return "one turn map eigenvalue modulus {} at dp/p {}".format(np.max(moduli), dpop)
+
+    return None
 
 #----------------------------------------------------------------------
 
-# calculate the x and y tunes for each particle
-def analyze_propagation():
-    h5 = h5py.File('tracks.h5', 'r')
-    trks = h5.get('track_coords')[()]
-    npart = trks.shape[1]
-    xtunes = np.zeros(npart)
-    ytunes = np.zeros(npart)
-    for n in range(npart):
-        # calculate tunes this particle
-        t = tune_suite.interp_tunes(trks[:, n, 0:6].transpose())
-        xtunes[n] = t[0]
-        ytunes[n] = t[1]
-    return xtunes, ytunes
+# The x and y eigentunes of the linear one turn map of lattice about
+# the closed orbit at momentum offset dpop (see tune_suite.eigentunes()).
+# Raises RuntimeError if the map is not stable.
+
+def linear_map_tunes(lattice, dpop):
+    SIM = synergia.simulation
+    SIM.Lattice_simulator.calculate_closed_orbit(lattice, dpop)
+    one_turn_map = np.array(SIM.Lattice_simulator.get_linear_one_turn_map(lattice, dpop))[0:4, 0:4]
+    return tune_suite.eigentunes(one_turn_map, opts.prescreen_tol)
 
 #----------------------------------------------------------------------
 
-def evaluate(kxl_values, chatty=False, adjust_tunes=True):
+# The tunes of mode "map" at all the survey momentum offsets. The
+# offsets are shared out over the ranks of survey_comm and gathered
+# back. Returns an Evaluation.
+
+def evaluate_map_mode(lattice):
+    comm = rr_tune_survey.survey_comm
+    dpop_offsets = rr_tune_survey.get_dpop_offsets()
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+
+    local = {}
+    reason = None
+    with stage_timing.stage("linear_map_tunes"):
+        for k in range(rank, len(dpop_offsets), size):
+            try:
+                local[k] = linear_map_tunes(lattice, dpop_offsets[k])
+            except Exception as e:
+                reason = "linear map tunes at dp/p {}: {}".format(dpop_offsets[k], e)
+                break
+
+    if size > 1:
+        with stage_timing.stage("gather_tunes"):
+            gathered = comm.allgather((local, reason))
+    else:
+        gathered = [(local, reason)]
+
+    tunes = np.zeros((len(dpop_offsets), 2))
+    for (rank_tunes, rank_reason) in gathered:
+        if rank_reason:
+            return Evaluation(None, None, status='unstable', reason=rank_reason)
+        for k, kt in rank_tunes.items():
+            tunes[k] = kt
+    stage_timing.count("offsets", len(dpop_offsets))
+
+    return Evaluation(tunes[:, 0], tunes[:, 1])
+
+#----------------------------------------------------------------------
+
+# Mode "adaptive": track every opts.adaptive_step-th survey offset, then
+# for up to opts.adaptive_rounds rounds track the middle offset of every
+# interval where the interpolated tune curve is not good enough (see
+# adaptive_grid.refine()). The tunes are interpolated back onto all the
+# survey offsets. The tracking uses the turns and the tune analysis
+# method of the fidelity level settings level. Returns an Evaluation.
+
+def evaluate_adaptive(lattice, level):
+    dpop_offsets = rr_tune_survey.get_dpop_offsets()
+    grid = rr_tune_survey.get_freq_offsets()
+    measured = get_measured_tunes() if opts.adaptive_residual_tol else None
+    all_coords = rr_tune_survey.get_initial_coords(lattice, dpop_offsets)
+
+    tracked = np.zeros(0, dtype=int)
+    tunes = np.zeros((0, 2))
+    new = adaptive_grid.coarse_indices(len(grid), opts.adaptive_step)
+    turns = 0
+    for refinement in range(opts.adaptive_rounds + 1):
+        tracks = run_particles(lattice, all_coords[new], level['turns'], reuse_tracks=True)
+        trks = tracks.get_tracks()
+        turns = max(turns, trks.shape[0]-1)
+        if tracks.get_abort_reason():
+            return Evaluation(None, None, turns=turns, status='unstable', reason=tracks.abort_reason)
+        if tracks.interrupted:
+            return interrupted_evaluation(turns)
+        new_tunes = np.column_stack(analyze_propagation(trks, level['analysis']))
+
+        tracked = np.concatenate((tracked, new))
+        tunes = np.concatenate((tunes, new_tunes))
+        order = np.argsort(tracked)
+        tracked = tracked[order]
+        tunes = tunes[order]
+
+        if refinement == opts.adaptive_rounds:
+            break
+        new = adaptive_grid.refine(grid, tracked, tunes, opts.adaptive_tol, measured, opts.adaptive_residual_tol)
+        if len(new) == 0:
+            break
+
+    stage_timing.count("particles", len(tracked))
+    stage_timing.count("turns", turns)
+    tunes = adaptive_grid.interpolate(grid, tracked, tunes)
+    return Evaluation(tunes[:, 0], tunes[:, 1], turns=turns)
+
+#----------------------------------------------------------------------
+
+def evaluate_uncached(kxl_values, chatty=False, adjust_tunes=True, mode="track", fidelity="full"):
+    if mode not in ("track", "map", "adaptive"):
+        raise RuntimeError("unknown evaluate mode: {}".format(mode))
+    level = get_fidelity_level(fidelity)
 
     try:
         lattice = generate_lattice(kxl_values, adjust_tunes=adjust_tunes)
-    except:
+    except Exception as e:
         if DEBUG:
             print("exception generated from generate_lattice")
             print("kxl_values: ", kxl_values, flush=True)
-        return None
+        return Evaluation(None, None, status='unstable', reason="generate_lattice failed: {}".format(e))
+
+    if opts.prescreen:
+        with stage_timing.stage("prescreen"):
+            reason = prescreen_lattice(lattice)
+        if reason:
+            if chatty:
+                print("lattice failed prescreen: ", reason)
+            return Evaluation(None, None, status='unstable', reason=reason)
 
     if chatty:
         print("read lattice, ", len(lattice.get_elements()), ", length: ", lattice.get_length())
@@ -132,11 +597,11 @@ def evaluate(kxl_values, chatty=False, adjust_tunes=True):
 
         try:
             (nux, nuy, cdT) = synergia.simulation.Lattice_simulator.calculate_tune_and_cdt(lattice)
-        except:
+        except Exception as e:
             if DEBUG:
                 print("exception generated from calculate_tunes_and_cdt")
                 print("kxl_values: ", kxl_values, flush=True)
-            return None
+            return Evaluation(None, None, status='unstable', reason="calculate_tune_and_cdt failed: {}".format(e))
 
         if chatty:
             print('tune x: ', nux)
@@ -146,11 +611,11 @@ def evaluate(kxl_values, chatty=False, adjust_tunes=True):
 
         try:
             chrom_t = synergia.simulation.Lattice_simulator.get_chromaticities(lattice)
-        except:
+        except Exception as e:
             if DEBUG:
                 print("exception generated from calculate_get_chromaticities")
                 print("kxl_values: ", kxl_values, flush=True)
-            return None
+            return Evaluation(None, None, status='unstable', reason="get_chromaticities failed: {}".format(e))
 
         if chatty:
             print('horizontal chromaticity: ', chrom_t.horizontal_chromaticity)
@@ -158,9 +623,255 @@ def evaluate(kxl_values, chatty=False, adjust_tunes=True):
             print('compaction factor: ', chrom_t.momentum_compaction)
             print('slip factor: ', chrom_t.slip_factor)
 
-    run_particles(lattice)
+    return evaluate_lattice(lattice, mode, level, chatty)
+
+#----------------------------------------------------------------------
+
+# Get the tunes of a lattice from generate_lattice() with mode and the
+# fidelity level settings level. Returns an Evaluation.
+
+def evaluate_lattice(lattice, mode="track", level=None, chatty=False):
+    if level is None:
+        level = get_fidelity_level("full")
+
+    if mode == "map":
+        return evaluate_map_mode(lattice)
+    if mode == "adaptive":
+        return evaluate_adaptive(lattice, level)
+
+    # track every offset_step-th survey offset
+    coords = None
+    if level['offset_step'] > 1:
+        grid = rr_tune_survey.get_freq_offsets()
+        tracked = adaptive_grid.coarse_indices(len(grid), level['offset_step'])
+        coords = rr_tune_survey.get_initial_coords(lattice, rr_tune_survey.get_dpop_offsets()[tracked])
+
+    tracks = run_particles(lattice, coords, level['turns'], reuse_tracks=True)
+    trks = tracks.get_tracks()
+    stage_timing.count("particles", trks.shape[1])
+    stage_timing.count("turns", trks.shape[0]-1)
+    if tracks.get_abort_reason():
+        return Evaluation(None, None, turns=trks.shape[0]-1, status='unstable', reason=tracks.abort_reason)
+    if tracks.interrupted:
+        return interrupted_evaluation(trks.shape[0]-1)
+
+    (xtunes, ytunes) = analyze_propagation(trks, level['analysis'])
+    if coords is not None:
+        tunes = adaptive_grid.interpolate(grid, tracked, np.column_stack((xtunes, ytunes)))
+        (xtunes, ytunes) = (tunes[:, 0], tunes[:, 1])
+
+    if chatty:
+        print("tunes from ", trks.shape[0]-1, " turns")
+
+    return Evaluation(xtunes, ytunes, turns=trks.shape[0]-1)
 
-    return analyze_propagation()
+#----------------------------------------------------------------------
+
+# Long-lived worker processes for evaluate_many(). Workers are started
+# with "spawn" so each one imports synergia (and initializes MPI) once
+# itself rather than inheriting the state of the parent. Each worker
+# runs in its own subdirectory of opts.scratch so files written during
+# an evaluation do not collide. The pool is started again when the
+# settings the workers copy change.
+
+worker_pool = None
+worker_pool_size = 0
+worker_pool_settings = None
+
+def init_worker(template_file, tunes_file, opt_values, scratch):
+    global RR_template_file, tune_data_file
+    RR_template_file = template_file
+    tune_data_file = tunes_file
+    for name, value in opt_values.items():
+        setattr(opts, name, value)
+
+    workdir = os.path.join(scratch, "worker_{}".format(os.getpid()))
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+
+# the template file, the measured tunes file and the worker_opts values
+# new workers are set up with, as (template_file, tunes_file,
+# opt_values). The files are absolute paths since the workers run in
+# their own directories.
+def get_worker_settings():
+    opt_values = {name: getattr(opts, name) for name in worker_opts}
+    for name in ("cache_dir", "stats_file", "scratch"):
+        if opt_values[name]:
+            opt_values[name] = os.path.abspath(opt_values[name])
+    return (os.path.abspath(RR_template_file), os.path.abspath(tune_data_file), opt_values)
+
+# a new pool of worker processes set up with settings, by default the
+# ones of this process
+def create_worker_pool(workers, settings=None):
+    if settings is None:
+        settings = get_worker_settings()
+    (template_file, tunes_file, opt_values) = settings
+    scratch = opt_values['scratch'] or tempfile.mkdtemp(prefix="rr_scratch_")
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(template_file, tunes_file, opt_values, scratch))
+
+def get_worker_pool(workers=None):
+    global worker_pool, worker_pool_size, worker_pool_settings
+    if workers is None:
+        workers = os.cpu_count()
+
+    settings = get_worker_settings()
+    if worker_pool is not None and (worker_pool_size != workers or worker_pool_settings != settings):
+        shutdown_worker_pool()
+
+    if worker_pool is None:
+        worker_pool = create_worker_pool(workers, settings)
+        worker_pool_size = workers
+        worker_pool_settings = settings
+
+    return worker_pool
+
+def shutdown_worker_pool():
+    global worker_pool, worker_pool_size, worker_pool_settings
+    if worker_pool is not None:
+        worker_pool.shutdown(cancel_futures=True)
+    worker_pool = None
+    worker_pool_size = 0
+    worker_pool_settings = None
+
+atexit.register(shutdown_worker_pool)
+
+#----------------------------------------------------------------------
+
+# Evaluate a list of kxl_values dicts concurrently on worker processes.
+# The workers stay alive between calls so the synergia import is paid
+# once per worker. Results are returned in the order of kxl_list.
+# This must not be called from a process launched with mpirun.
+#
+# A worker that dies (killed, out of memory, a crash in synergia) breaks
+# the whole pool. The pool is then shut down and the points without a
+# result are submitted once more to a new pool. If that pool breaks too,
+# BrokenProcessPool is raised.
+
+def evaluate_many(kxl_list, workers=None, adjust_tunes=True, mode="track", fidelity="full"):
+    results = [None]*len(kxl_list)
+    for attempt in range(2):
+        todo = [k for k, result in enumerate(results) if result is None]
+        try:
+            pool = get_worker_pool(workers)
+            futures = [(k, pool.submit(evaluate, kxl_list[k], False, adjust_tunes, mode, fidelity)) for k in todo]
+            for (k, f) in futures:
+                results[k] = f.result()
+            return results
+        except concurrent.futures.process.BrokenProcessPool:
+            shutdown_worker_pool()
+            if attempt == 1:
+                raise
+
+#----------------------------------------------------------------------
+
+# The residual of an Evaluation against the measured tunes: the x tune
+# differences followed by the y tune differences.
+
+def get_residual(result):
+    measured = get_measured_tunes()
+    return np.concatenate((result[0] - measured[:, 0], result[1] - measured[:, 1]))
+
+#----------------------------------------------------------------------
+
+# Finite difference Jacobian of the residual with respect to the knobs
+# (keys of kxl_values such as 'k2l_even'), with one step size per knob
+# or one for all. The base point and the perturbed points are all
+# evaluated at once by evaluate_many(). An already computed base
+# Evaluation can be passed as base, otherwise it comes from the result
+# cache when there is one. Returns (residual, jacobian) with jacobian
+# of shape (len(residual), len(knobs)). Raises ValueError for a knob
+# that is not in rr_tune_survey.knob_names and RuntimeError if any of
+# the points is unstable.
+
+def jacobian(kxl_values, knobs, step_sizes, scheme="forward", workers=None, adjust_tunes=True,
+             mode="track", base=None, fidelity="full"):
+    if scheme not in ("forward", "central"):
+        raise RuntimeError("unknown finite difference scheme: {}".format(scheme))
+    unknown = [knob for knob in knobs if knob not in rr_tune_survey.knob_names]
+    if unknown:
+        raise ValueError("jacobian: unknown knobs {}, the knobs are {}".format(unknown, rr_tune_survey.knob_names))
+    step_sizes = np.broadcast_to(np.asarray(step_sizes, dtype='d'), (len(knobs),))
+
+    points = []
+    for knob, step in zip(knobs, step_sizes):
+        signs = (1.0,) if scheme == "forward" else (1.0, -1.0)
+        for sign in signs:
+            point = dict(kxl_values)
+            point[knob] = kxl_values.get(knob, 0.0) + sign*step
+            points.append(point)
+
+    if base is None:
+        results = evaluate_many([kxl_values] + points, workers, adjust_tunes, mode, fidelity)
+        base = results.pop(0)
+    else:
+        results = evaluate_many(points, workers, adjust_tunes, mode, fidelity)
+    for point, result in zip([kxl_values] + points, [base] + results):
+        if not result.ok:
+            raise RuntimeError("jacobian: unstable at {}: {}".format(point, result.reason))
+
+    residual = get_residual(base)
+    jac = np.zeros((len(residual), len(knobs)))
+    for k, step in enumerate(step_sizes):
+        if scheme == "forward":
+            jac[:, k] = (get_residual(results[k]) - residual)/step
+        else:
+            jac[:, k] = (get_residual(results[2*k]) - get_residual(results[2*k+1]))/(2.0*step)
+    return residual, jac
+
+#----------------------------------------------------------------------
+
+# Compare mode "map" with tracking for kxl_values. Returns the largest
+# differences of the x and y tunes over the momentum offsets and
+# whether both are within opts.map_mode_tol. Use this as the tracked
+# confirmation after a series of mode "map" iterations.
+
+def check_map_mode(kxl_values, adjust_tunes=True):
+    mapped = evaluate(kxl_values, adjust_tunes=adjust_tunes, mode="map")
+    tracked = evaluate(kxl_values, adjust_tunes=adjust_tunes, mode="track")
+    if not (mapped.ok and tracked.ok):
+        return {'ok': False, 'map_status': mapped.status, 'track_status': tracked.status}
+    max_dxtune = np.max(np.abs(mapped[0] - tracked[0]))
+    max_dytune = np.max(np.abs(mapped[1] - tracked[1]))
+    return {
+        'ok': bool(max_dxtune <= opts.map_mode_tol and max_dytune <= opts.map_mode_tol),
+        'max_dxtune': max_dxtune,
+        'max_dytune': max_dytune,
+        'map_wall': mapped.stats['wall'],
+        'track_wall': tracked.stats['wall'],
+    }
+
+#----------------------------------------------------------------------
+
+# Check that memory stays flat over a long series of evaluations:
+# evaluate kxl_values evaluations times with the result cache off,
+# printing the RSS every report_period evaluations. Returns the RSS after
+# every evaluation and the growth per evaluation fitted over the second
+# half, after the first evaluations have warmed up the caches.
+
+def memory_soak(kxl_values, evaluations=10000, report_period=100, adjust_tunes=True, fidelity="full"):
+    cache_dir = opts.cache_dir
+    opts.cache_dir = None
+    rss = np.zeros(evaluations)
+    try:
+        for k in range(evaluations):
+            result = evaluate(kxl_values, adjust_tunes=adjust_tunes, fidelity=fidelity)
+            rss[k] = result.stats['rss_mb']
+            if report_period and (k+1) % report_period == 0:
+                print("memory_soak: {} evaluations, RSS {:.1f} MB, last growth {:.3f} MB".format(
+                    k+1, rss[k], result.stats['rss_growth_mb']), flush=True)
+    finally:
+        opts.cache_dir = cache_dir
+
+    half = evaluations//2
+    if evaluations - half > 1:
+        growth = np.polyfit(np.arange(half, evaluations), rss[half:], 1)[0]
+    else:
+        growth = 0.0
+    return {'rss_mb': rss, 'growth_mb_per_evaluation': growth}
 
 #----------------------------------------------------------------------
 
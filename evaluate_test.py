@@ -17,8 +17,8 @@ kxl_values = {
 }
 
 eval = evaluate.evaluate(kxl_values, chatty=True, adjust_tunes=True)
-if eval is None:
-    print(f'Lattice with values: {kxl_values}, is not stable or evaluatable')
+if not eval.ok:
+    print(f'Lattice with values: {kxl_values}, is not stable or evaluatable: {eval.reason}')
 else:
     xtunes1, ytunes1 = eval
     print('xtunes: ', xtunes1)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+import os
+import json
+from mpi4py import MPI
+import numpy as np
+import synergia
+
+import evaluate
+import rr_tune_survey
+from rr_options import opts
+
+# Farm mode: evaluate many points inside one mpirun.
+#
+# The world communicator is split into groups of farm_group_size ranks.
+# Each group is a separate tune survey with its own communicators, so
+# its bunch is distributed over the group only, and the groups take the
+# points in turn (point i goes to group i % ngroups). Each group works
+# in its own subdirectory of scratch. The results are gathered to world
+# rank 0, the coordinator.
+#
+#    mpirun -np 64 python farm.py --farm_group_size=4 --farm_points=points.json
+
+# the (group, ngroups, group_comm, group_commxx) of this rank for each
+# group size, split once and kept for later farm_evaluate() calls
+farm_groups = {}
+
+# the working directory the first farm_evaluate() was called from, which
+# relative scratch paths are taken from
+start_dir = None
+
+# Split the world into groups of group_size ranks and make the survey
+# run on this rank's group. Returns (group, ngroups, group_comm).
+def split_world(group_size):
+    if group_size not in farm_groups:
+        world = MPI.COMM_WORLD
+        if world.Get_size() % group_size != 0:
+            raise RuntimeError("farm: {} ranks do not divide into groups of {}".format(world.Get_size(), group_size))
+        group = world.Get_rank() // group_size
+        ngroups = world.Get_size() // group_size
+        group_comm = world.Split(group, world.Get_rank())
+        group_commxx = synergia.utils.Commxx().split(group, world.Get_rank())
+        farm_groups[group_size] = (group, ngroups, group_comm, group_commxx)
+
+    (group, ngroups, group_comm, group_commxx) = farm_groups[group_size]
+    rr_tune_survey.survey_comm = group_comm
+    rr_tune_survey.survey_commxx = group_commxx
+    return (group, ngroups, group_comm)
+
+# Move into the working directory of group under opts.scratch, keeping
+# the files named by relative paths reachable.
+def enter_group_dir(group):
+    global start_dir
+    if start_dir is None:
+        start_dir = os.getcwd()
+    evaluate.RR_template_file = os.path.join(start_dir, evaluate.RR_template_file)
+    evaluate.tune_data_file = os.path.join(start_dir, evaluate.tune_data_file)
+    for name in ("cache_dir", "stats_file"):
+        if getattr(opts, name):
+            setattr(opts, name, os.path.join(start_dir, getattr(opts, name)))
+
+    workdir = os.path.join(start_dir, opts.scratch or ".", "farm_group_{}".format(group))
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+
+#-----------------------------------------------------------------------
+
+# Evaluate the list of kxl_values dicts over the groups. Every world
+# rank calls this. Returns the Evaluations in the order of kxl_list on
+# world rank 0 and None on the other ranks.
+def farm_evaluate(kxl_list, group_size=None, adjust_tunes=True, mode="track", fidelity="full"):
+    if group_size is None:
+        group_size = opts.farm_group_size
+    (group, ngroups, group_comm) = split_world(group_size)
+    enter_group_dir(group)
+
+    results = {}
+    for index in range(group, len(kxl_list), ngroups):
+        result = evaluate.evaluate(kxl_list[index], adjust_tunes=adjust_tunes, mode=mode, fidelity=fidelity)
+        results[index] = result
+
+    # the group leaders hold the results
+    if group_comm.Get_rank() != 0:
+        results = {}
+    gathered = MPI.COMM_WORLD.gather(results, root=0)
+    if MPI.COMM_WORLD.Get_rank() != 0:
+        return None
+
+    all_results = {}
+    for group_results in gathered:
+        all_results.update(group_results)
+    return [all_results[index] for index in range(len(kxl_list))]
+
+#-----------------------------------------------------------------------
+
+# Save the tunes of all the points, with NaN for the unstable ones, and
+# their status.
+def save_results(filename, kxl_list, results):
+    noffsets = len(rr_tune_survey.get_dpop_offsets())
+    xtunes = np.full((len(results), noffsets), np.nan)
+    ytunes = np.full((len(results), noffsets), np.nan)
+    for k, result in enumerate(results):
+        if result.ok:
+            xtunes[k] = result[0]
+            ytunes[k] = result[1]
+    np.savez(filename,
+             kxl=np.array([evaluate.get_knob_vector(kxl_values) for kxl_values in kxl_list]),
+             knob_names=np.array(rr_tune_survey.knob_names),
+             xtunes=xtunes, ytunes=ytunes,
+             status=np.array([result.status for result in results]),
+             reason=np.array([result.reason or "" for result in results]))
+
+def main():
+    with open(opts.farm_points, 'r') as f:
+        kxl_list = json.load(f)
+    results_file = os.path.abspath(opts.farm_results)
+
+    results = farm_evaluate(kxl_list)
+
+    if results is not None:
+        save_results(results_file, kxl_list, results)
+        print("farm: ", len(results), " points, ", sum(1 for r in results if r.ok), " stable, saved to ",
+              results_file)
+
+if __name__ == "__main__":
+    main()
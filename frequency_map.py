@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+import evaluate
+import rr_tune_survey
+import tune_suite
+import stage_timing
+from rr_options import opts
+
+# Frequency map of a lattice over momentum offset and amplitude.
+#
+# One bunch holds a particle for every point of the grid of momentum
+# offsets dp/p, x amplitudes Ax and y amplitudes Ay: each starts on the
+# dispersion orbit of its dp/p, displaced by Ax in x and Ay in y. After
+# one propagation the x and y tunes of every particle are found with one
+# batched FFT over the first half of its track and another over the
+# second half. The tune diffusion is log10 of the size of the change of
+# the tunes between the halves, so regular orbits have a very negative
+# diffusion and chaotic ones a diffusion near 0. The amplitude dependent
+# tune shifts and the chromatic detuning are read off the same map.
+#
+#    python frequency_map.py --fmap_x_amplitudes=[0,0.002,0.004,0.008] --fmap_file=fmap.npz
+
+# amplitude given to the particles at zero amplitude so they still
+# oscillate for tune detection
+min_amplitude = 1.0e-7
+
+#-----------------------------------------------------------------------
+
+# Initial coordinates of the grid particles, shape
+# (len(dpop_offsets)*len(x_amplitudes)*len(y_amplitudes), 6), with the
+# dp/p index slowest and the Ay index fastest.
+
+def get_grid_coords(lattice, dpop_offsets, x_amplitudes, y_amplitudes):
+    with stage_timing.stage("get_lf"):
+        lf = rr_tune_survey.get_lf(lattice)
+
+    x_amplitudes = np.where(np.asarray(x_amplitudes) == 0.0, min_amplitude, x_amplitudes)
+    y_amplitudes = np.where(np.asarray(y_amplitudes) == 0.0, min_amplitude, y_amplitudes)
+    (dpop, ax, ay) = np.meshgrid(dpop_offsets, x_amplitudes, y_amplitudes, indexing='ij')
+    dpop = dpop.ravel()
+
+    coords = np.zeros((len(dpop), 6))
+    coords[:, 0] = lf.dispersion.hor * dpop + ax.ravel()
+    coords[:, 1] = lf.dPrime.hor * dpop
+    coords[:, 2] = lf.dispersion.ver * dpop + ay.ravel()
+    coords[:, 3] = lf.dPrime.ver * dpop
+    coords[:, 5] = dpop
+    return coords
+
+#-----------------------------------------------------------------------
+
+# The x and y tunes of the first and second halves of tracks trks of
+# shape (turns+1, particles, 6), shape (2, particles, 2), and which
+# particles were lost: they were last recorded (last_turns from
+# Track_buffer.get_last_turns()) before the end of the tracks, or their
+# |x| or |y| went beyond lost_amplitude or stopped being finite. The
+# tunes of lost particles are NaN.
+
+def half_track_tunes(trks, lost_amplitude, last_turns):
+    turns = trks.shape[0] - 1
+    half = turns//2
+    with np.errstate(invalid='ignore'):
+        amplitude = np.max(np.abs(trks[..., [0, 2]]), axis=(0, 2))
+    lost = (last_turns < turns) | np.logical_not(amplitude <= lost_amplitude)
+
+    tunes = np.zeros((2, trks.shape[1], 2))
+    for k, start in enumerate((0, half)):
+        halftrack = trks[start:start+half][..., [0, 2]]
+        halftrack = np.where(lost[np.newaxis, :, np.newaxis], 0.0, halftrack)
+        with np.errstate(invalid='ignore'):
+            tunes[k] = tune_suite.batch_interp_tunes(halftrack, planes=(0, 1))
+    tunes[:, lost, :] = np.nan
+    return (tunes, lost)
+
+#-----------------------------------------------------------------------
+
+# Track the grid of dp/p, x amplitude and y amplitude through lattice for
+# turns turns and return the frequency map as a dict of arrays: the
+# grid axes, the tunes of the first half of the turns and the tune
+# diffusion, both indexed by (dp/p, Ax, Ay), and which particles were
+# lost. The whole survey does not stop when particles are lost, a
+# particle counts as lost when it leaves the bunch before the last turn,
+# goes beyond lost_amplitude (by default opts.abort_amplitude, if set)
+# or stops being finite. The tracking follows opts.tracking_engine.
+
+def frequency_map(lattice, turns, x_amplitudes, y_amplitudes, dpop_offsets=None, lost_amplitude=None):
+    if dpop_offsets is None:
+        dpop_offsets = rr_tune_survey.get_dpop_offsets()
+    if lost_amplitude is None:
+        lost_amplitude = opts.abort_amplitude or np.inf
+    shape = (len(dpop_offsets), len(x_amplitudes), len(y_amplitudes))
+
+    coords = get_grid_coords(lattice, dpop_offsets, x_amplitudes, y_amplitudes)
+    tracks = evaluate.run_particles(lattice, coords, turns, abort=False)
+    trks = tracks.get_tracks()
+    last_turns = tracks.get_last_turns()
+    stage_timing.count("particles", trks.shape[1])
+    stage_timing.count("turns", trks.shape[0]-1)
+
+    with stage_timing.stage("interp_tunes"):
+        (tunes, lost) = half_track_tunes(trks, lost_amplitude, last_turns)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        diffusion = np.log10(np.sqrt(np.sum((tunes[1] - tunes[0])**2, axis=1)))
+
+    return {
+        'dpop_offsets': np.asarray(dpop_offsets),
+        'x_amplitudes': np.asarray(x_amplitudes, dtype='d'),
+        'y_amplitudes': np.asarray(y_amplitudes, dtype='d'),
+        'turns': trks.shape[0]-1,
+        'xtunes': tunes[0, :, 0].reshape(shape),
+        'ytunes': tunes[0, :, 1].reshape(shape),
+        'diffusion': diffusion.reshape(shape),
+        'lost': lost.reshape(shape),
+    }
+
+# Write the frequency map fmap to the npz file filename, with the tunes
+# and the diffusion in single precision. Only rank 0 of the survey
+# communicator writes.
+
+def save_frequency_map(filename, fmap):
+    if rr_tune_survey.survey_comm.Get_rank() != 0:
+        return
+    compact = dict(fmap)
+    for name in ('xtunes', 'ytunes', 'diffusion'):
+        compact[name] = fmap[name].astype(np.float32)
+    np.savez_compressed(filename, **compact)
+
+#-----------------------------------------------------------------------
+
+def main():
+    lattice = evaluate.generate_lattice({})
+    dpop_offsets = rr_tune_survey.get_dpop_offsets()[::opts.fmap_offset_step]
+    fmap = frequency_map(lattice, opts.turns, opts.fmap_x_amplitudes, opts.fmap_y_amplitudes, dpop_offsets)
+    save_frequency_map(opts.fmap_file, fmap)
+    if rr_tune_survey.survey_comm.Get_rank() == 0:
+        print("frequency map of ", fmap['lost'].size, " particles, ", np.count_nonzero(fmap['lost']),
+              " lost, saved to ", opts.fmap_file)
+
+if __name__ == "__main__":
+    main()
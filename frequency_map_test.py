@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("synergia")
+import frequency_map
+
+# tracks of shape (turns+1, particles, 6) of particles with tunes
+# (xtune, ytune) and amplitude 1e-3 in both planes
+def oscillating_tracks(turns, tunes):
+    n = np.arange(turns+1)[:, np.newaxis]
+    trks = np.zeros((turns+1, len(tunes), 6))
+    for (k, (xtune, ytune)) in enumerate(tunes):
+        trks[:, k, 0] = 1.0e-3*np.cos(2*np.pi*xtune*n[:, 0])
+        trks[:, k, 2] = 1.0e-3*np.cos(2*np.pi*ytune*n[:, 0])
+    return trks
+
+def test_particle_lost_partway_is_lost():
+    turns = 256
+    trks = oscillating_tracks(turns, [(0.43, 0.41), (0.44, 0.40), (0.42, 0.39)])
+    # particle 1 leaves the bunch after turn 100, its later turns stay 0
+    trks[101:, 1, :] = 0.0
+    last_turns = np.array([turns, 100, turns])
+
+    (tunes, lost) = frequency_map.half_track_tunes(trks, np.inf, last_turns)
+
+    np.testing.assert_array_equal(lost, [False, True, False])
+    assert np.all(np.isnan(tunes[:, 1, :]))
+    np.testing.assert_allclose(tunes[:, 0, :], [[0.43, 0.41], [0.43, 0.41]], atol=1.0e-3)
+    np.testing.assert_allclose(tunes[:, 2, :], [[0.42, 0.39], [0.42, 0.39]], atol=1.0e-3)
+
+def test_amplitude_cut_still_applies():
+    turns = 128
+    trks = oscillating_tracks(turns, [(0.43, 0.41), (0.44, 0.40)])
+    trks[60:, 1, 0] = 0.02
+
+    (tunes, lost) = frequency_map.half_track_tunes(trks, 0.01, np.full(2, turns))
+
+    np.testing.assert_array_equal(lost, [False, True])
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+import os
+import atexit
+import asyncio
+
+import synergia
+
+import evaluate
+import stage_timing
+from rr_options import opts
+
+# Evaluate a batch of candidates with lattice preparation overlapped
+# with propagation.
+#
+# An evaluation is split in two: prepare_candidate() builds the lattice
+# (knob binding, tune adjustment, RF tuning) and prescreens it, and
+# propagate_candidate() tracks it. They run on separate pools of worker
+# processes, so while the propagation workers track earlier candidates
+# the preparation workers already get the next lattices ready. A
+# prepared lattice is handed over as JSON. At most lookahead prepared
+# lattices wait for a propagation worker at a time.
+#
+# This must not be called from a process launched with mpirun.
+
+prepare_pool = None
+prepare_pool_size = 0
+prepare_pool_settings = None
+
+def get_prepare_pool(workers):
+    global prepare_pool, prepare_pool_size, prepare_pool_settings
+    settings = evaluate.get_worker_settings()
+    if prepare_pool is not None and (prepare_pool_size != workers or prepare_pool_settings != settings):
+        shutdown_prepare_pool()
+    if prepare_pool is None:
+        prepare_pool = evaluate.create_worker_pool(workers, settings)
+        prepare_pool_size = workers
+        prepare_pool_settings = settings
+    return prepare_pool
+
+def shutdown_prepare_pool():
+    global prepare_pool, prepare_pool_size, prepare_pool_settings
+    if prepare_pool is not None:
+        prepare_pool.shutdown(cancel_futures=True)
+    prepare_pool = None
+    prepare_pool_size = 0
+    prepare_pool_settings = None
+
+atexit.register(shutdown_prepare_pool)
+
+#-----------------------------------------------------------------------
+
+# Runs on a preparation worker. Returns (lattice_json, None, stats) for
+# a lattice ready to propagate, or (None, Evaluation, stats) when it is
+# unstable.
+def prepare_candidate(kxl_values, adjust_tunes=True):
+    with stage_timing.recording() as record:
+        try:
+            lattice = evaluate.generate_lattice(kxl_values, adjust_tunes=adjust_tunes)
+            reason = None
+        except Exception as e:
+            reason = "generate_lattice failed: {}".format(e)
+
+        if reason is None and opts.prescreen:
+            with stage_timing.stage("prescreen"):
+                reason = evaluate.prescreen_lattice(lattice)
+
+        if reason is None:
+            with stage_timing.stage("lattice_json"):
+                lattice_json = lattice.as_json()
+
+    if reason is not None:
+        return (None, evaluate.Evaluation(None, None, status='unstable', reason=reason), record.as_dict())
+    return (lattice_json, None, record.as_dict())
+
+# Runs on a propagation worker. Returns (Evaluation, stats).
+def propagate_candidate(lattice_json, mode="track", fidelity="full"):
+    with stage_timing.recording() as record:
+        with stage_timing.stage("lattice_json"):
+            lattice = synergia.lattice.Lattice.load_from_json(lattice_json)
+        result = evaluate.evaluate_lattice(lattice, mode, evaluate.get_fidelity_level(fidelity))
+    return (result, record.as_dict())
+
+#-----------------------------------------------------------------------
+
+# the stats of an evaluation done in the two stages, with the stage
+# times of both and the wall time from submission to result
+def combine_stats(prepare_stats, propagate_stats, wall):
+    stats = dict(propagate_stats or prepare_stats)
+    stats['stages'] = dict(prepare_stats['stages'])
+    if propagate_stats is not None:
+        stats['stages'].update(propagate_stats['stages'])
+        stats['cpu'] = prepare_stats['cpu'] + propagate_stats['cpu']
+    stats['wall'] = wall
+    return stats
+
+async def evaluate_pipeline(kxl_list, prepare_workers=None, propagate_workers=None, lookahead=None,
+                            adjust_tunes=True, mode="track", fidelity="full"):
+    if propagate_workers is None:
+        propagate_workers = max(1, (os.cpu_count() * 3)//4)
+    if prepare_workers is None:
+        prepare_workers = max(1, os.cpu_count() - propagate_workers)
+    if lookahead is None:
+        lookahead = propagate_workers
+
+    loop = asyncio.get_running_loop()
+    prepare_executor = get_prepare_pool(prepare_workers)
+    propagate_executor = evaluate.get_worker_pool(propagate_workers)
+    cache = evaluate.get_result_cache()
+    ready = asyncio.Semaphore(propagate_workers + lookahead)
+
+    async def one(kxl_values):
+        start = loop.time()
+        if cache is not None:
+            key = evaluate.evaluation_key(kxl_values, adjust_tunes, mode, fidelity)
+            entry = cache.get(key)
+            if entry is not None:
+                result = evaluate.cached_evaluation(entry)
+                result.fidelity = fidelity
+                result.stats = {'wall': loop.time() - start, 'counters': {'cache_hit': 1}}
+                return result
+
+        # a candidate holds the semaphore from preparation until its
+        # propagation finishes, which bounds the prepared lattices
+        async with ready:
+            (lattice_json, result, prepare_stats) = await loop.run_in_executor(
+                prepare_executor, prepare_candidate, kxl_values, adjust_tunes)
+            propagate_stats = None
+            if result is None:
+                (result, propagate_stats) = await loop.run_in_executor(
+                    propagate_executor, propagate_candidate, lattice_json, mode, fidelity)
+
+        result.fidelity = fidelity
+        result.stats = combine_stats(prepare_stats, propagate_stats, loop.time() - start)
+        result.stats['kxl'] = evaluate.get_knob_vector(kxl_values).tolist()
+        result.stats['mode'] = mode
+        result.stats['fidelity'] = fidelity
+        result.stats['status'] = result.status
+        if cache is not None:
+            evaluate.store_evaluation(cache, key, kxl_values, result, adjust_tunes, mode, fidelity)
+        if opts.stats_file:
+            stage_timing.append_jsonl(opts.stats_file, result.stats)
+        return result
+
+    return await asyncio.gather(*[one(kxl_values) for kxl_values in kxl_list])
+
+# Evaluate the list of kxl_values dicts with the pipeline. Returns the
+# Evaluations in the order of kxl_list, like evaluate.evaluate_many().
+def evaluate_many_pipelined(kxl_list, prepare_workers=None, propagate_workers=None, lookahead=None,
+                            adjust_tunes=True, mode="track", fidelity="full"):
+    return asyncio.run(evaluate_pipeline(kxl_list, prepare_workers, propagate_workers, lookahead,
+                                         adjust_tunes, mode, fidelity))
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+
+import re
+import time
+import hashlib
+import numpy as np
+import synergia
+
+import rr_tune_survey
+import rr_setup
+import taylor_map
+import tune_suite
+
+# Reduced Recycler lattice for fast tune surveys.
+#
+# Most of the elements are drifts, dipoles and quadrupoles whose maps
+# are the same for every evaluation. A Reduced_lattice collapses each run
+# of such linear elements between two varied or nonlinear elements into
+# one map: a transfer matrix in x, x', y, y' whose entries and dispersion
+# terms are polynomials in dp/p of reduced_chromatic_order. The varied
+# elements stay separate. The MPS*U shims and the other thin multipoles
+# become thin kicks, and the qt60x trim quads become thick quadrupoles.
+# The kick of a multipole whose components are rotated, by the T0..T5
+# angles of MAD8 or a tilt of the whole element, is rotated with them.
+# Any other nonlinear element (a thick sextupole, a combined function
+# magnet with k2, a multipole with k{n}s skew strengths) gets a
+# polynomial map of map_order of its own.
+#
+# The maps are fitted to sample particles tracked through their
+# elements by synergia, and are cached by the contents of the
+# elements, so only the first reduced lattice of a template pays for
+# the fits. The per turn cost scales with the number of nonlinear
+# elements instead of the number of elements.
+
+# half widths of the region the maps are fitted over in x, x', y and
+# y' around the dispersion orbit of the largest survey offset. That
+# orbit and dp/p are fitted over fit_margin times their extent.
+segment_scales = (5.0e-3, 5.0e-4, 5.0e-3, 5.0e-4)
+fit_margin = 1.2
+
+trim_regex = re.compile("qt60([1-9])[a-d]")
+
+# element types whose maps are linear in x, x', y and y'
+linear_types = ("drift", "sbend", "rbend", "quadrupole", "marker", "monitor", "hmonitor", "vmonitor",
+                "instrument", "rfcavity", "hkicker", "vkicker", "kicker")
+
+# a linear type element with one of these is nonlinear
+nonlinear_attributes = ("k2", "k3")
+
+factorials = np.array([1.0, 1.0, 2.0, 6.0, 24.0, 120.0])
+
+# the fitted maps by the contents of their elements
+piece_maps = {}
+
+#-----------------------------------------------------------------------
+
+# The largest |D| and |D'| in x and y over the elements of lattice.
+def get_dispersion_extents(lattice):
+    rr_tune_survey.get_lf(lattice)
+    extents = np.zeros(4)
+    for elem in lattice.get_elements():
+        lf = elem.lf
+        extents = np.maximum(extents, np.abs([lf.dispersion.hor, lf.dPrime.hor, lf.dispersion.ver, lf.dPrime.ver]))
+    return extents
+
+# The half widths of the region to fit the maps of lattice over for the
+# survey offsets. The dispersion orbit of the largest offset reaches
+# max|D| max|dp/p| somewhere in the ring (about 9.5 mm in x for the
+# Recycler), so that is added to segment_scales.
+def get_fit_scales(lattice):
+    dpop_max = np.max(np.abs(rr_tune_survey.get_dpop_offsets()))
+    orbit = fit_margin * dpop_max * get_dispersion_extents(lattice)
+    return (tuple(float(scale + extent) for (scale, extent) in zip(segment_scales, orbit))
+            + (float(max(fit_margin*dpop_max, taylor_map.map_min_scales[4])),))
+
+# Exponents in (x, x', y, y', dp/p) of the monomials of a map that is
+# linear in x, x', y and y' with coefficients of order chromatic_order
+# in dp/p.
+def chromatic_exponents(chromatic_order):
+    exponents = []
+    for k in range(chromatic_order+1):
+        exponents.append([0, 0, 0, 0, k])
+        for j in range(4):
+            exponent = [0, 0, 0, 0, k]
+            exponent[j] = 1
+            exponents.append(exponent)
+    return np.array(sorted(exponents, key=sum), dtype=int)
+
+# Track coords of shape (particles, 6) once through the list of elements
+# of lattice with synergia. Returns the coordinates at the end.
+
+def track_elements(lattice, elements, coords):
+    segment = synergia.lattice.Lattice("batch_segment")
+    for elem in elements:
+        segment.append(elem)
+    ref_part = lattice.get_reference_particle()
+    segment.set_reference_particle(ref_part)
+    segment.set_all_string_attribute("extractor_type", "libff")
+
+    if rr_tune_survey.survey_commxx is None:
+        sim = synergia.simulation.Bunch_simulator.create_single_bunch_simulator(
+            ref_part, coords.shape[0], 1.0e9)
+    else:
+        sim = synergia.simulation.Bunch_simulator.create_single_bunch_simulator(
+            ref_part, coords.shape[0], 1.0e9, rr_tune_survey.survey_commxx)
+    rr_tune_survey.populate_bunch(sim.get_bunch(), coords)
+
+    tracks = rr_tune_survey.Track_buffer(1, coords.shape[0], comm=rr_tune_survey.survey_comm)
+    tracks.record(sim.get_bunch())
+    sim.reg_prop_action_turn_end(tracks.turn_end)
+
+    propagator = rr_tune_survey.create_propagator(None, segment)
+    simlog = synergia.utils.parallel_utils.Logger(0, synergia.utils.parallel_utils.LoggerV.INFO_TURN)
+    propagator.propagate(sim, simlog, 1)
+
+    return tracks.get_tracks()[1]
+
+#-----------------------------------------------------------------------
+
+# Thin multipole kick of strengths b of shape (candidates, 6), where
+# b[:, n] is knl/n!, on coords of shape (candidates, particles, 6) in
+# place: px - i py changes by -sum b_n (x + i y)**n. b is complex for
+# rotated components (see multipole_strengths()).
+
+def multipole_kick(coords, b):
+    z = coords[..., 0] + 1j*coords[..., 2]
+    kick = np.repeat(b[:, -1, np.newaxis], z.shape[1], axis=1).astype(complex)
+    for n in range(b.shape[1]-2, -1, -1):
+        kick = kick*z + b[:, n, np.newaxis]
+    coords[..., 1] -= kick.real
+    coords[..., 3] += kick.imag
+
+# the cosine-like and sine-like solutions of u'' = -k u and the
+# derivative of the cosine-like one over length, for any sign of k
+def quad_functions(k, length):
+    phi = np.sqrt(k + 0j)*length
+    c = np.cos(phi).real
+    s = (length*np.sinc(phi/np.pi)).real
+    return (c, s, -k*s)
+
+# Thick quadrupole of length with k1 of shape (candidates,) on coords in
+# place. The focusing scales with 1/(1 + dp/p). The path length is not
+# changed, cdt does not matter with the RF off.
+
+def thick_quad(coords, k1, length):
+    pscale = 1.0 + coords[..., 5]
+    k = k1[:, np.newaxis] / pscale
+    for (u, pu, ku) in ((0, 1, k), (2, 3, -k)):
+        (c, s, cp) = quad_functions(ku, length)
+        u0 = coords[..., u].copy()
+        up = coords[..., pu] / pscale
+        coords[..., u] = c*u0 + s*up
+        coords[..., pu] = (cp*u0 + c*up) * pscale
+
+#-----------------------------------------------------------------------
+
+# What a Reduced_lattice does with elem: "linear", "kick", "trim" or
+# "nonlinear".
+def element_kind(elem):
+    type_name = elem.get_type_name()
+    if type_name == "multipole":
+        skew = [elem.get_double_attribute("k{}s".format(n), 0.0) for n in range(6)]
+        if np.any(skew):
+            return "nonlinear"
+        return "kick"
+    if type_name == "quadrupole" and trim_regex.match(elem.get_name()):
+        return "trim"
+    if type_name in linear_types and not any(elem.get_double_attribute(attr, 0.0)
+                                             for attr in nonlinear_attributes):
+        return "linear"
+    return "nonlinear"
+
+# The strengths of multipole elem for multipole_kick(), shape (1, 6).
+# Component n rotated by the angle t_n about s (MAD8 Tn, plus the tilt
+# of the element) acts as the normal one on coordinates rotated by
+# -t_n, so its strength is knl/n! exp(-i (n+1) t_n).
+def multipole_strengths(elem):
+    tilt = elem.get_double_attribute("tilt", 0.0)
+    b = np.zeros((1, 6), dtype=complex)
+    for n in range(6):
+        angle = tilt + elem.get_double_attribute("t{}".format(n), 0.0)
+        b[0, n] = elem.get_double_attribute("k{}l".format(n), 0.0)/factorials[n] * np.exp(-1j*(n+1)*angle)
+    if not np.any(b.imag):
+        b = b.real
+    return b
+
+# The map of the list of elements of lattice fitted with the monomials
+# exponents (all up to order if None), from the cache if the same
+# elements were fitted before.
+def get_piece_map(lattice, elements, order, scales, exponents=None):
+    digest = hashlib.sha256()
+    for elem in elements:
+        digest.update(elem.as_string().encode())
+    key = (digest.hexdigest(), lattice.get_reference_particle().get_momentum(), order, scales,
+           None if exponents is None else exponents.tobytes())
+    if key not in piece_maps:
+        samples = taylor_map.get_samples(order, scales, len(piece_maps))
+        coords_out = track_elements(lattice, elements, samples)
+        piece_maps[key] = taylor_map.Taylor_map.fit(samples, coords_out, order, taylor_map.map_variables,
+                                                    scales, exponents)
+    return piece_maps[key]
+
+#-----------------------------------------------------------------------
+
+# A lattice from evaluate.generate_lattice() as a short list of pieces:
+# ("map", Taylor_map), ("kick", multipole_strengths() of shape (1, 6)) or
+# ("trim", (k1 of shape (1,), length)). The RF of lattice is turned off.
+
+class Reduced_lattice:
+    def __init__(self, lattice, chromatic_order, element_order, scales):
+        rr_setup.setup_rf_cavities(lattice, 0, 588)
+        self.exponents = chromatic_exponents(chromatic_order)
+        self.pieces = []
+        self.nelements = 0
+
+        run = []
+        for elem in lattice.get_elements():
+            self.nelements = self.nelements + 1
+            kind = element_kind(elem)
+            if kind == "linear":
+                run.append(elem)
+                continue
+            self.add_run(lattice, run, chromatic_order, scales)
+            run = []
+            if kind == "kick":
+                self.pieces.append(("kick", multipole_strengths(elem)))
+            elif kind == "trim":
+                self.pieces.append(("trim", (np.array([elem.get_double_attribute("k1", 0.0)]), elem.get_length())))
+            else:
+                self.pieces.append(("map", get_piece_map(lattice, [elem], element_order, scales)))
+        self.add_run(lattice, run, chromatic_order, scales)
+
+    def add_run(self, lattice, run, chromatic_order, scales):
+        if run:
+            self.pieces.append(("map", get_piece_map(lattice, run, chromatic_order+1, scales, self.exponents)))
+
+    # one turn of coords of shape (1, particles, 6)
+    def apply(self, coords):
+        for (kind, piece) in self.pieces:
+            if kind == "map":
+                coords = piece.apply(coords)
+            elif kind == "kick":
+                multipole_kick(coords, piece)
+            else:
+                thick_quad(coords, piece[0], piece[1])
+        return coords
+
+    # Track coords of shape (particles, 6) for turns turns into the
+    # Track_buffer tracks, stopping if tracks sees an amplitude beyond
+    # its abort_amplitude.
+    def track(self, coords, turns, tracks):
+        ids = np.arange(coords.shape[0])
+        coords = coords[np.newaxis].copy()
+        tracks.store(ids, coords[0])
+        with np.errstate(all='ignore'):
+            for turn in range(turns):
+                coords = self.apply(coords)
+                tracks.store(ids, coords[0])
+                if tracks.abort_reason:
+                    break
+        return tracks
+
+#-----------------------------------------------------------------------
+
+# The tune survey of rr_tune_survey.run_rr() done with the reduced
+# lattice of lattice. Returns the Track_buffer with the tracks.
+
+def run_reduced(lattice, turns, chromatic_order, element_order, abort_amplitude=None, coords=None):
+    if coords is None:
+        coords = rr_tune_survey.get_initial_coords(lattice, rr_tune_survey.get_dpop_offsets())
+
+    reduced = Reduced_lattice(lattice, chromatic_order, element_order, get_fit_scales(lattice))
+
+    tracks = rr_tune_survey.Track_buffer(turns, coords.shape[0], abort_amplitude)
+    return reduced.track(coords, turns, tracks)
+
+#-----------------------------------------------------------------------
+
+# Compare the tunes from tracking the reduced lattice with the tunes
+# from element by element tracking of the survey particles for turns
+# turns. Returns a dict with the largest tune differences, the element
+# and piece counts and the time per turn of both.
+
+def validate_reduced(lattice, turns, chromatic_order, element_order):
+    coords = rr_tune_survey.get_initial_coords(lattice, rr_tune_survey.get_dpop_offsets())
+    t0 = time.time()
+    element_tracks = rr_tune_survey.run_rr(lattice, turns, coords=coords).get_tracks()
+    t1 = time.time()
+    reduced = Reduced_lattice(lattice, chromatic_order, element_order, get_fit_scales(lattice))
+    t2 = time.time()
+    reduced_tracks = reduced.track(coords, turns, rr_tune_survey.Track_buffer(turns, coords.shape[0])).get_tracks()
+    t3 = time.time()
+
+    element_tunes = tune_suite.batch_interp_tunes(element_tracks)
+    reduced_tunes = tune_suite.batch_interp_tunes(reduced_tracks)
+    dtunes = np.abs(reduced_tunes - element_tunes)
+
+    return {
+        'chromatic_order': chromatic_order,
+        'turns': turns,
+        'elements': reduced.nelements,
+        'pieces': len(reduced.pieces),
+        'max_dxtune': np.max(dtunes[:, 0]),
+        'max_dytune': np.max(dtunes[:, 1]),
+        'element_turn_time': (t1 - t0)/turns,
+        'reduced_build_time': t2 - t1,
+        'reduced_turn_time': (t3 - t2)/turns,
+    }
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+import os
+import json
+import time
+import hashlib
+import tempfile
+import numpy as np
+
+# On-disk cache of evaluation results. Each entry is a .npz file named
+# by a hash of everything that determines the result, so identical
+# evaluations share an entry no matter which process computed it.
+#
+# Entries are written to a temporary file and renamed into place, so
+# several processes can read and write the same cache directory at
+# the same time without locks: a reader sees either a complete entry
+# or no entry. The least recently used entries are removed when the
+# total size goes over max_bytes, down to evict_fraction of max_bytes
+# so that the next eviction is some writes away. Each Result_cache keeps a running
+# estimate of the total from its own writes, so a write only scans the
+# directory when the estimate goes over max_bytes, or every
+# rescan_period writes to pick up what other processes wrote.
+
+# hash of a dict of the inputs of an evaluation
+def make_key(inputs):
+    text = json.dumps(inputs, sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+#-----------------------------------------------------------------------
+
+file_digests = {}
+
+# hash of the contents of a file, remembered while the file is unchanged
+def file_digest(filename):
+    filename = os.path.abspath(filename)
+    st = os.stat(filename)
+    key = (filename, st.st_mtime, st.st_size)
+    if key not in file_digests:
+        with open(filename, 'rb') as f:
+            file_digests[key] = hashlib.sha256(f.read()).hexdigest()
+    return file_digests[key]
+
+#-----------------------------------------------------------------------
+
+# The arrays of the entry file path as a dict, with the strings
+# converted back to str. Raises OSError, ValueError or EOFError if the
+# file is missing or not completely written.
+def load_entry(path):
+    with np.load(path, allow_pickle=False) as data:
+        entry = {}
+        for name in data.files:
+            value = data[name]
+            if value.dtype.kind == 'U':
+                value = str(value)
+            entry[name] = value
+    return entry
+
+#-----------------------------------------------------------------------
+
+class Result_cache:
+    # temporary files older than this are left over from a writer that
+    # died and are removed during eviction
+    stale_tmp_age = 3600.0
+    # writes between scans of the directory
+    rescan_period = 100
+    # eviction stops below this fraction of max_bytes
+    evict_fraction = 0.9
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # estimated total size, None until the first scan
+        self.size = None
+        self.writes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key[0:2], key + ".npz")
+
+    # Returns a dict of the stored arrays, with the strings converted
+    # back to str, or None if there is no entry for key.
+    def get(self, key):
+        path = self.path(key)
+        try:
+            entry = load_entry(path)
+            # mark as recently used for eviction
+            os.utime(path)
+        except (OSError, ValueError, EOFError):
+            # missing, evicted while reading, or not completely written
+            return None
+        return entry
+
+    # store the arrays and strings given as keyword arguments under key
+    def put(self, key, **entry):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            old_size = os.stat(path).st_size
+        except OSError:
+            old_size = 0
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **entry)
+                new_size = f.tell()
+            os.replace(tmpname, path)
+        except BaseException:
+            try:
+                os.remove(tmpname)
+            except OSError:
+                pass
+            raise
+
+        self.writes = self.writes + 1
+        if self.size is None or self.writes % self.rescan_period == 0:
+            self.evict()
+            return
+        self.size = self.size + new_size - old_size
+        if self.size > self.max_bytes:
+            self.evict()
+
+    # Yields (key, entry) for every complete entry, like get() but
+    # without marking them as used.
+    def items(self):
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for fname in sorted(filenames):
+                if not fname.endswith(".npz"):
+                    continue
+                try:
+                    entry = load_entry(os.path.join(dirpath, fname))
+                except (OSError, ValueError, EOFError):
+                    continue
+                yield (fname[:-len(".npz")], entry)
+
+    # Scan the directory. If the cache is over max_bytes, remove least
+    # recently used entries until it is below evict_fraction of it.
+    def evict(self):
+        entries = []
+        total = 0
+        now = time.time()
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for fname in filenames:
+                path = os.path.join(dirpath, fname)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if fname.endswith(".tmp"):
+                    if now - st.st_mtime > self.stale_tmp_age:
+                        self.remove(path)
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total = total + st.st_size
+
+        if total > self.max_bytes:
+            entries.sort()
+            for mtime, size, path in entries:
+                if total <= self.evict_fraction*self.max_bytes:
+                    break
+                self.remove(path)
+                total = total - size
+        self.size = total
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            # another process got there first
+            pass
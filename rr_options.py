@@ -118,3 +118,54 @@ opts.add("scratch", None, "directory for temporary diagnostic files", str)
 opts.add("min_freq_offset", -2000, "minimum frequency offset (MHz)")
 opts.add("max_freq_offset", 2000, "maximum frequency offset (MHz)")
 opts.add("freq_offset_step", 100, "step size between frequency measurements")
+opts.add("tracks_file", None, "also save the tune survey tracks to this HDF5 file", str)
+opts.add("converge_tol", None, "stop the tune survey once the tunes change less than this between checks", float)
+opts.add("check_period", 128, "turns between checks during the tune survey", int)
+opts.add("converge_checks", 2, "consecutive converged checks needed to stop the tune survey", int)
+opts.add("prescreen", False, "check closed orbits and one turn map stability before tracking", bool)
+opts.add("prescreen_tol", 1.0e-6, "largest one turn map eigenvalue modulus excess over 1 that is stable", float)
+opts.add("abort_amplitude", None, "stop the tune survey when a particle |x| or |y| exceeds this [m], e.g. 0.05", float)
+opts.add("abort_period", 16, "turns between amplitude checks during the tune survey", int)
+opts.add("tracking_engine", "elements", "tune survey tracking: elements (element by element), map (one-turn polynomial map) or reduced (reduced lattice)", str)
+opts.add("map_mode_tol", 1.0e-3, "largest tune difference between evaluate() modes map and track that check_map_mode() accepts", float)
+opts.add("checkpoint", False, "checkpoint the tune survey every checkpoint_period turns in scratch and resume from it", bool)
+opts.add("checkpoint_max_turns", None, "with checkpoint, the most turns one run of the tune survey propagates, run again to continue", int)
+opts.add("adaptive_step", 4, "evaluate() mode adaptive starts by tracking every this many survey offsets", int)
+opts.add("adaptive_tol", 1.0e-4, "largest estimated tune interpolation error that mode adaptive accepts", float)
+opts.add("adaptive_residual_tol", None, "also refine where interpolated tunes differ from tunefreq_fine.txt by more than this", float)
+opts.add("adaptive_rounds", 3, "largest number of refinement rounds of mode adaptive", int)
+opts.add("reuse_buffers", True, "reuse the track arrays of the tune survey from one evaluation to the next", bool)
+opts.add("gc_period", 100, "run the garbage collector every this many evaluations, 0 for never", int)
+opts.add("reduced_chromatic_order", 2, "dp/p order of the linear element runs of the reduced lattice", int)
+opts.add("fmap_x_amplitudes", [0.0, 0.001, 0.002, 0.004], "frequency_map.py x amplitudes [m]")
+opts.add("fmap_y_amplitudes", [0.0, 0.001, 0.002, 0.004], "frequency_map.py y amplitudes [m]")
+opts.add("fmap_offset_step", 1, "frequency_map.py uses every this many survey momentum offsets", int)
+opts.add("fmap_file", "frequency_map.npz", "frequency_map.py output file", str)
+opts.add("da_dpop_offsets", [-0.001, 0.0, 0.001], "dynamic_aperture.py momentum offsets")
+opts.add("da_rays", 7, "dynamic_aperture.py rays in (x, y) from the x to the y axis", int)
+opts.add("da_max_amplitude", 0.03, "dynamic_aperture.py largest amplitude along a ray [m]", float)
+opts.add("da_bisections", 6, "dynamic_aperture.py bisections of the stable amplitude", int)
+opts.add("da_turns", 512, "dynamic_aperture.py turns a particle must survive", int)
+opts.add("da_file", "dynamic_aperture.npz", "dynamic_aperture.py output file", str)
+opts.add("batch_map_order", 3, "order of the segment maps of the batch tracker", int)
+opts.add("batch_size", 64, "largest number of candidates the batch tracker propagates together", int)
+opts.add("stats_file", None, "append the timing record of every evaluation to this JSON-lines file", str)
+
+# farm mode
+opts.add("farm_group_size", 1, "MPI ranks per group in farm mode, each group evaluates different points", int)
+opts.add("farm_points", "farm_points.json", "farm.py JSON file with the list of kxl_values dicts to evaluate", str)
+opts.add("farm_results", "farm_results.npz", "farm.py output file of the tunes of all the points", str)
+
+# evaluation server
+opts.add("server_address", "rr_eval.sock", "eval_server.py Unix socket path, or host:port on the loopback interface", str)
+opts.add("server_workers", None, "eval_server.py worker processes, the number of CPUs if not set", int)
+
+# evaluation result cache
+opts.add("cache_dir", None, "directory of the evaluate() result cache, no caching if not set", str)
+opts.add("cache_max_mb", 1000, "maximum size of the result cache in MB", float)
+
+# surrogate model
+opts.add("surrogate_pca_tol", 1.0e-6, "fraction of the tune vector variance the surrogate components may leave out", float)
+opts.add("surrogate_refit_period", 50, "additions to the surrogate between refits of its components and kernel", int)
+opts.add("surrogate_kappa", 2.0, "surrogate screening keeps candidates within this many sigma of the best residual", float)
+opts.add("surrogate_uncertainty_tol", None, "surrogate screening also keeps candidates with a larger RMS tune uncertainty", float)
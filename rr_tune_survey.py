@@ -1,11 +1,23 @@
-# from mpi4py import MPI
+import re
+from mpi4py import MPI
 import numpy as np
 import synergia
 
 import rr_setup
+import tune_suite
+import stage_timing
+import checkpoint
 
 from rr_options import opts
 
+# The communicator the survey bunch is distributed over. The off-momentum
+# particles are independent, so each rank tracks its share of them and
+# the tracks are summed over the ranks. survey_commxx is the synergia
+# communicator over the same ranks, None for the synergia default of
+# all ranks (see farm.py for running on part of the ranks).
+survey_comm = MPI.COMM_WORLD
+survey_commxx = None
+
 def print_statistics(bunch):
     parts = bunch.get_particles_numpy()
     print(parts.shape, ", ", parts.size)
@@ -46,6 +58,11 @@ def get_rr_lattice_for_opt(RR_template, RR_line, kxl_values):
     with open(RR_template, 'r') as template:
         template = template.read()
 
+    return parse_rr_template(template, RR_line, kxl_values)
+
+#-----------------------------------------------------------------------
+
+def parse_rr_template(template, RR_line, kxl_values):
     # Values for K0LEVEN and K0L_ODD are set to 0 in the template itself.
     k1leven = kxl_values.get('k1l_even', 0)
     k1lodd = kxl_values.get('k1l_odd', 0)
@@ -90,6 +107,58 @@ def get_rr_lattice_for_opt(RR_template, RR_line, kxl_values):
 
 #-----------------------------------------------------------------------
 
+# The knobs of the template as used in kxl_values
+knob_names = ('k1l_even', 'k1l_odd', 'k2l_even', 'k2l_odd', 'k3l_even',
+              'k3l_odd', 'k4l_even', 'k4l_odd', 'k5l_even', 'k5l_odd')
+
+# matches an attribute whose expression ends by adding a knob, e.g.
+# K3L=0.1297873+VALUEFOR_K3L_EVEN or K4L=VALUEFOR_K4L_EVEN
+knob_regex = re.compile(r"(K[0-9]L)=(?:[^,]*\+)?VALUEFOR_(K[0-9]L_(?:EVEN|ODD))\s*(?:,|$)")
+
+# Find the elements (the MPS*U shims) whose strengths depend on the
+# VALUEFOR_ knobs. Returns a dict indexed by element name of lists of
+# (attribute, knob) pairs.
+
+def get_knob_elements(template):
+    knob_elements = {}
+    for line in template.splitlines():
+        if line.startswith('!') or 'VALUEFOR_' not in line:
+            continue
+        name = line.split(':')[0].strip().lower()
+        for attr, knob in knob_regex.findall(line):
+            knob_elements.setdefault(name, []).append((attr.lower(), knob.lower()))
+    return knob_elements
+
+#-----------------------------------------------------------------------
+
+# A lattice parsed once with all the knobs at 0 that gives out copies
+# with the knobs applied. Every knob only ever adds to an element
+# strength in the template, so applying a knob is setting the strength
+# to its value at knob 0 plus the knob value, without reparsing.
+
+class Knob_bound_lattice:
+    def __init__(self, lattice, knob_elements):
+        self.lattice_json = lattice.as_json()
+        self.knob_elements = knob_elements
+        self.base_values = {}
+        for elem in lattice.get_elements():
+            name = elem.get_name()
+            for attr, knob in knob_elements.get(name, []):
+                self.base_values[(name, attr)] = elem.get_double_attribute(attr, 0.0)
+
+        if not self.base_values:
+            raise RuntimeError("Knob_bound_lattice: no knob dependent elements in lattice")
+
+    def get_lattice(self, kxl_values):
+        lattice = synergia.lattice.Lattice.load_from_json(self.lattice_json)
+        for elem in lattice.get_elements():
+            name = elem.get_name()
+            for attr, knob in self.knob_elements.get(name, []):
+                elem.set_double_attribute(attr, self.base_values[(name, attr)] + kxl_values.get(knob, 0))
+        return lattice
+
+#-----------------------------------------------------------------------
+
 def get_lattice_rr():
     lattice_file = open("rr_tuned.json", "r")
     lattice = synergia.lattice.Lattice.load_from_json(lattice_file.read())
@@ -99,10 +168,17 @@ def get_lattice_rr():
     return lattice
 
 
-def get_dpop_offsets():
+# the RF frequency offsets of the survey particles
+def get_freq_offsets():
     # We're going to create particles with momenta at frequency offsets
     # between -2000 and +2000 (Hz) at intevals of 100 Hz.
-    
+    min_freq_off = opts.min_freq_offset
+    max_freq_off = opts.max_freq_offset
+    freq_step = opts.freq_offset_step
+    # add half step to max so the upper frequency is included in range
+    return np.arange(min_freq_off, max_freq_off+0.5*freq_step, freq_step)
+
+def get_dpop_offsets():
     # From Rob Ainsworth:
     #revtime=11.135e-6
     revtime = 1.1134653259322681e-05
@@ -118,47 +194,58 @@ def get_dpop_offsets():
     #
     # dp/p = df * -T/(h * eta) 
 
-    min_freq_off = opts.min_freq_offset
-    max_freq_off = opts.max_freq_offset
-    freq_step = opts.freq_offset_step
-    # add half step to max so the upper frequency is included in range
-    df_list = np.arange(min_freq_off, max_freq_off+0.5*freq_step, freq_step)
+    df_list = get_freq_offsets()
     dpop_list = df_list * revtime/(h*np.abs(eta))
     return dpop_list
 
 #-----------------------------------------------------------------------
 
-def populate_bunch(bunch, lattice, np, screen):
-    dpop_offsets = get_dpop_offsets()
-    print('Number of frequencies to run: ', len(dpop_offsets), file=screen)
-    print('    offsets from ', dpop_offsets[0], 'to', dpop_offsets[-1], file=screen)
-
-    bunch.checkout_particles()
+# Initial coordinates of the survey particles, one for each momentum
+# offset in dpop_offsets, as an array of shape (particles, 6).
 
+def get_initial_coords(lattice, dpop_offsets):
     # get the lattice functions to populate the particles correctly
-    lf = get_lf(lattice)
+    with stage_timing.stage("get_lf"):
+        lf = get_lf(lattice)
     Dx = lf.dispersion.hor
     Dy = lf.dispersion.ver
     Dpx = lf.dPrime.hor
     Dpy = lf.dPrime.ver
-    
-    lp = bunch.get_particles_numpy()
 
-    # The total size of the array is padded for alignment so I limit the
-    # the index of particle number to match the size of dpop_offsets
-    lp[:np, 5] = dpop_offsets
+    coords = np.zeros((len(dpop_offsets), 6))
+    coords[:, 5] = dpop_offsets
 
     # set the particles starting transverse coordinate offset by
     # the amount determined by the dispersion*dpop offset.
-    lp[:np, 0] = Dx * dpop_offsets
-    lp[:np, 1] = Dpx * dpop_offsets
-    lp[:np, 2] = Dy * dpop_offsets
-    lp[:np, 3] = Dpy * dpop_offsets
+    coords[:, 0] = Dx * dpop_offsets
+    coords[:, 1] = Dpx * dpop_offsets
+    coords[:, 2] = Dy * dpop_offsets
+    coords[:, 3] = Dpy * dpop_offsets
 
     # except for the particle at 0 which needs to have a small offset
     # for tune detection
-    lp[20, 0] = 1.0e-7
-    lp[20, 2] = 1.0e-7
+    on_momentum = (dpop_offsets == 0.0)
+    coords[on_momentum, 0] = 1.0e-7
+    coords[on_momentum, 2] = 1.0e-7
+
+    return coords
+
+#-----------------------------------------------------------------------
+
+# The bunch is distributed over the ranks of the communicator, so each
+# rank only holds some of the particles. Each particle gets the
+# coordinates of its ID from coords.
+
+def populate_bunch(bunch, coords):
+    bunch.checkout_particles()
+
+    lp = bunch.get_particles_numpy()
+
+    # The total size of the array is padded for alignment so I limit the
+    # the index of particle number to the local particles
+    nlocal = bunch.get_local_num()
+    ids = lp[:nlocal, 6].astype(int)
+    lp[:nlocal, 0:6] = coords[ids, :]
 
     bunch.checkin_particles()
 
@@ -167,16 +254,26 @@ def populate_bunch(bunch, lattice, np, screen):
 
 # Create the simulator object for the simulation which characteristics
 # determined by the reference particle
+# The particles start at coords, by default the survey particles at
+# the offsets from get_dpop_offsets().
 
-def create_simulator(lattice, screen):
+def create_simulator(lattice, screen, coords=None):
     ref_part = lattice.get_reference_particle()
 
     # We're only  going to propagate a small number of particles
     # each at a different momentum to determine their tunes so I
     # don't really need the grid stuff.
 
-    macro_particles = len(get_dpop_offsets())
+    if coords is None:
+        dpop_offsets = get_dpop_offsets()
+        print('Number of frequencies to run: ', len(dpop_offsets), file=screen)
+        print('    offsets from ', dpop_offsets[0], 'to', dpop_offsets[-1], file=screen)
+        coords = get_initial_coords(lattice, dpop_offsets)
+
+    macro_particles = coords.shape[0]
     print("Number of macroparticles:", macro_particles, file=screen)
+    if survey_comm.Get_size() > 1:
+        print("    distributed over ", survey_comm.Get_size(), " ranks", file=screen)
 
     real_particles = 1.0e9     # propagating without space charge
     
@@ -187,14 +284,19 @@ def create_simulator(lattice, screen):
     ref_part = lattice.get_reference_particle()
 
     # Initiate bunch simulator (For now single bunch)
-    sim = synergia.simulation.Bunch_simulator.create_bunch_train_simulator(
-        ref_part, macro_particles, real_particles, num_bunches, spacing
-    )
+    if survey_commxx is None:
+        sim = synergia.simulation.Bunch_simulator.create_bunch_train_simulator(
+            ref_part, macro_particles, real_particles, num_bunches, spacing
+        )
+    else:
+        sim = synergia.simulation.Bunch_simulator.create_bunch_train_simulator(
+            ref_part, macro_particles, real_particles, num_bunches, spacing, survey_commxx
+        )
 
     # Enforce longitudinal bucket conditions (Mandatory if RF is turned on)
     sim.set_longitudinal_boundary(synergia.bunch.LongitudinalBoundary.aperture, spacing)
 
-    populate_bunch(sim.get_bunch(), lattice, macro_particles, screen)
+    populate_bunch(sim.get_bunch(), coords)
 
 
     return sim
@@ -219,10 +321,148 @@ def create_propagator(comm, lattice):
 
 #-----------------------------------------------------------------------
 
+# Turn-by-turn particle coordinates kept in memory so that the tune
+# analysis does not need to round-trip through an HDF5 file.
+# coords has shape (turns+1, nparticles, 6): the initial coordinates
+# followed by the coordinates at the end of every turn. Particles are
+# placed by their ID so the ordering within the bunch does not matter.
+
+# If abort_amplitude is given, abort_reason is set at the first turn
+# where any particle has |x| or |y| beyond it (or is not finite).
+# interrupted is set by run_rr() when it stops at max_turns before the
+# end of the survey.
+
+class Track_buffer:
+    def __init__(self, turns, npart, abort_amplitude=None, comm=None):
+        self.coords = np.zeros((turns+1, npart, 6))
+        self.gathered = None
+        self.nrecorded = 0
+        self.last_turns = np.full(npart, -1)
+        self.abort_amplitude = abort_amplitude
+        self.abort_reason = None
+        self.interrupted = False
+        self.comm = comm
+
+    # start over for another survey of the same shape
+    def reset(self, abort_amplitude=None, comm=None):
+        self.coords[:] = 0.0
+        self.nrecorded = 0
+        self.last_turns[:] = -1
+        self.abort_amplitude = abort_amplitude
+        self.abort_reason = None
+        self.interrupted = False
+        self.comm = comm
+
+    def record(self, bunch):
+        bunch.checkout_particles()
+        lp = bunch.get_particles_numpy()
+        nlocal = bunch.get_local_num()
+        ids = lp[:nlocal, 6].astype(int)
+        self.store(ids, lp[:nlocal, 0:6])
+
+    # record the coordinates of the particles with IDs ids for a turn
+    def store(self, ids, coords):
+        self.coords[self.nrecorded, ids, :] = coords
+        self.last_turns[ids] = self.nrecorded
+        if self.abort_amplitude and self.abort_reason is None:
+            self.check_amplitude(self.coords[self.nrecorded])
+        self.nrecorded = self.nrecorded + 1
+
+    def check_amplitude(self, coords):
+        amplitude = np.max(np.abs(coords[:, [0, 2]]), axis=1)
+        bad = np.logical_not(amplitude <= self.abort_amplitude)
+        if np.any(bad):
+            n = np.nonzero(bad)[0][0]
+            self.abort_reason = "particle {} amplitude {} beyond {} at turn {}".format(
+                n, amplitude[n], self.abort_amplitude, self.nrecorded)
+
+    # called by the propagator at the end of every turn
+    def turn_end(self, sim, lattice, turn):
+        self.record(sim.get_bunch())
+
+    # The tracks recorded so far. Each rank only records the particles it
+    # holds, the others stay 0, so the full tracks are the sum over the
+    # ranks of comm. This is collective when there is more than one rank.
+    def get_tracks(self):
+        tracks = self.coords[:self.nrecorded]
+        if self.comm is None or self.comm.Get_size() == 1:
+            return tracks
+        if self.gathered is None:
+            self.gathered = np.zeros_like(self.coords)
+        all_tracks = self.gathered[:self.nrecorded]
+        with stage_timing.stage("gather_tracks"):
+            self.comm.Allreduce(tracks, all_tracks, op=MPI.SUM)
+        return all_tracks
+
+    # The last turn each particle was recorded at, -1 if never. A
+    # particle lost at an aperture is no longer in the bunch and stops
+    # being recorded. Collective like get_tracks().
+    def get_last_turns(self):
+        if self.comm is None or self.comm.Get_size() == 1:
+            return self.last_turns.copy()
+        last_turns = np.zeros_like(self.last_turns)
+        self.comm.Allreduce(self.last_turns, last_turns, op=MPI.MAX)
+        return last_turns
+
+    # the abort reason found on any rank, collective like get_tracks()
+    def get_abort_reason(self):
+        if self.comm is None or self.comm.Get_size() == 1:
+            return self.abort_reason
+        for reason in self.comm.allgather(self.abort_reason):
+            if reason:
+                self.abort_reason = reason
+                break
+        return self.abort_reason
+
+#-----------------------------------------------------------------------
+
+# One Track_buffer is kept for run_rr(reuse_tracks=True) and reused when
+# the shape of the survey is the same, so a long series of surveys does
+# not allocate and fault in new track arrays every time. The tracks of
+# such a survey are only valid until the next one.
+
+spare_tracks = None
+
+def get_track_buffer(turns, npart, abort_amplitude=None, comm=None):
+    global spare_tracks
+    if spare_tracks is None or spare_tracks.coords.shape != (turns+1, npart, 6):
+        spare_tracks = Track_buffer(turns, npart, abort_amplitude, comm)
+    else:
+        spare_tracks.reset(abort_amplitude, comm)
+    return spare_tracks
+
+#-----------------------------------------------------------------------
+
+# Decide when the tunes of all the particles have settled. update() is
+# given the tracks so far every check and returns True once every x and
+# y tune has changed by less than tol for checks consecutive checks.
+
+class Tune_convergence:
+    def __init__(self, tol, checks):
+        self.tol = tol
+        self.checks = checks
+        self.last_tunes = None
+        self.nconverged = 0
+
+    def update(self, trks):
+        tunes = tune_suite.batch_interp_tunes(trks)
+
+        if self.last_tunes is not None and np.max(np.abs(tunes - self.last_tunes)) < self.tol:
+            self.nconverged = self.nconverged + 1
+        else:
+            self.nconverged = 0
+        self.last_tunes = tunes
+
+        return self.nconverged >= self.checks
+
+#-----------------------------------------------------------------------
+
 # register the diagnostics needed to get the tune data
 # into the simulator which is passed in.
+# The tracks are captured into the Track_buffer tracks. They are only
+# written to the HDF5 file tracks_file if one is given.
 
-def register_diagnostics(sim):
+def register_diagnostics(sim, tracks, tracks_file=None):
 # Define diagnostics to run
     # For now keep options to single bunch
 
@@ -236,23 +476,48 @@ def register_diagnostics(sim):
     #diag = synergia.bunch.Diagnostics_full2("diag.h5")
     #sim.reg_diag_per_turn(diag)
 
+    # Keep the tracks of all 41 particles in memory
+    tracks.record(sim.get_bunch())
+    sim.reg_prop_action_turn_end(tracks.turn_end)
+
     # Save tracking data for all 41 particles
-    npart = sim.get_bunch().size()
-    diagtrk = synergia.bunch.Diagnostics_bulk_track("tracks.h5", npart)
-    sim.reg_diag_per_turn(diagtrk)
+    if tracks_file:
+        npart = sim.get_bunch().size()
+        diagtrk = synergia.bunch.Diagnostics_bulk_track(tracks_file, npart)
+        sim.reg_diag_per_turn(diagtrk)
 
     return sim
 
 #-----------------------------------------------------------------------
 
 # run a set of off-momentum particles for 2000 turns through the lattice
-# previously set up.
-
-def run_rr(lattice, turns):
+# previously set up. Returns the Track_buffer holding the tracks.
+# If converge_tol is given, the tunes are estimated every check_period
+# turns and the propagation stops early once they have converged (see
+# Tune_convergence).
+# If abort_amplitude is given, the propagation is stopped within
+# abort_period turns of a particle going beyond it and the Track_buffer
+# abort_reason says why.
+# The particles start at coords if given (see create_simulator).
+# If checkpoint_dir is given, the state of the survey is saved there
+# every checkpoint_period turns and a rerun of the same survey resumes
+# from the last checkpoint. tracks_file then only has the turns
+# propagated since the resume.
+# max_turns limits the turns propagated by this run, like
+# rr_modes.run_modes(), so a job fits a short queue slot. A survey that
+# stops there has interrupted set on its Track_buffer and is continued
+# by running it again with the same checkpoint_dir.
+# With reuse_tracks the tracks go into the shared buffer of
+# get_track_buffer().
+
+def run_rr(lattice, turns, tracks_file=None, converge_tol=None, check_period=128, converge_checks=2,
+           abort_amplitude=None, abort_period=16, coords=None, checkpoint_dir=None, checkpoint_period=200,
+           reuse_tracks=False, max_turns=None):
 
     screen = synergia.utils.parallel_utils.Logger(0, synergia.utils.parallel_utils.LoggerV.DEBUG)
 
-    sim = create_simulator(lattice, screen)
+    with stage_timing.stage("create_simulator"):
+        sim = create_simulator(lattice, screen, coords)
 
     # turn off RF and set open longitudinal boundary conditions
     # before propagating the particles
@@ -266,8 +531,25 @@ def run_rr(lattice, turns):
 
     propagator = create_propagator(comm, lattice)
 
-    register_diagnostics(sim)
-        
+    if reuse_tracks:
+        tracks = get_track_buffer(turns, sim.get_bunch().size(), abort_amplitude, survey_comm)
+    else:
+        tracks = Track_buffer(turns, sim.get_bunch().size(), abort_amplitude, survey_comm)
+    register_diagnostics(sim, tracks, tracks_file)
+    if converge_tol:
+        convergence = Tune_convergence(converge_tol, converge_checks)
+
+    turn = 0
+    if checkpoint_dir:
+        ckpt = checkpoint.Checkpoint(checkpoint_dir, checkpoint.run_key(
+            lattice.as_json(), turns, coords if coords is not None else get_dpop_offsets(),
+            survey_comm.Get_size()), survey_comm)
+        with stage_timing.stage("checkpoint"):
+            state = ckpt.load()
+        if state is not None:
+            turn = resume_survey(state, sim, tracks, convergence if converge_tol else None)
+            print("resuming tune survey at turn ", turn, file=screen)
+
     # Set maximum number of turns to simulate
     max_turns = turns
     sim.set_max_turns(turns)
@@ -277,8 +559,87 @@ def run_rr(lattice, turns):
     #simlog = synergia.utils.parallel_utils.Logger(0, synergia.utils.parallel_utils.LoggerV.INFO)
 
     # Propagate simulation for certain number of turns
-    propagator.propagate(sim, simlog, turns)
+    if not converge_tol and not abort_amplitude and not checkpoint_dir and not max_turns:
+        with stage_timing.stage("propagation"):
+            propagator.propagate(sim, simlog, turns)
+        return tracks
+
+    # Propagate in blocks that end at every check, each propagate()
+    # continues from the turn the simulator is at.
+    last_turn = turns
+    if max_turns:
+        last_turn = min(turns, turn + max_turns)
+    stopped = False
+    while turn < last_turn:
+        nturns = last_turn - turn
+        if converge_tol:
+            nturns = min(nturns, check_period - turn % check_period)
+        if abort_amplitude:
+            nturns = min(nturns, abort_period - turn % abort_period)
+        if checkpoint_dir:
+            nturns = min(nturns, checkpoint_period - turn % checkpoint_period)
+        with stage_timing.stage("propagation"):
+            propagator.propagate(sim, simlog, nturns)
+        turn = turn + nturns
+
+        if tracks.get_abort_reason():
+            print("stopping propagation: ", tracks.abort_reason, file=screen)
+            stopped = True
+            break
+        if converge_tol and turn % check_period == 0:
+            with stage_timing.stage("convergence_check"):
+                converged = convergence.update(tracks.get_tracks())
+            if converged:
+                print("tunes converged after ", turn, " turns", file=screen)
+                stopped = True
+                break
+        if checkpoint_dir and turn < turns and (turn % checkpoint_period == 0 or turn == last_turn):
+            with stage_timing.stage("checkpoint"):
+                save_survey(ckpt, turn, sim, tracks, convergence if converge_tol else None)
+
+    if not stopped and turn < turns:
+        print("stopping tune survey at turn ", turn, " of ", turns, ", run again to continue", file=screen)
+        tracks.interrupted = True
+        return tracks
+
+    if checkpoint_dir:
+        ckpt.remove()
+
+    return tracks
+
+#-----------------------------------------------------------------------
 
+# Save and restore the state of run_rr() at the end of turn: the local
+# particles, the tracks this rank recorded, the last turn each particle
+# was recorded at and the convergence history.
+
+def save_survey(ckpt, turn, sim, tracks, convergence=None):
+    state = {
+        'particles': checkpoint.get_particle_state(sim.get_bunch()),
+        'tracks': tracks.coords[:tracks.nrecorded],
+        'last_turns': tracks.last_turns,
+    }
+    if tracks.abort_reason:
+        state['abort_reason'] = tracks.abort_reason
+    if convergence is not None and convergence.last_tunes is not None:
+        state['last_tunes'] = convergence.last_tunes
+        state['nconverged'] = convergence.nconverged
+    ckpt.save(turn, **state)
+
+# returns the turn to continue from
+def resume_survey(state, sim, tracks, convergence=None):
+    checkpoint.set_particle_state(sim.get_bunch(), state['particles'])
+    nrecorded = state['tracks'].shape[0]
+    tracks.coords[:nrecorded] = state['tracks']
+    tracks.nrecorded = nrecorded
+    if 'last_turns' in state:
+        tracks.last_turns[:] = state['last_turns']
+    if 'abort_reason' in state:
+        tracks.abort_reason = str(state['abort_reason'])
+    if convergence is not None and 'last_tunes' in state:
+        convergence.last_tunes = state['last_tunes']
+        convergence.nconverged = int(state['nconverged'])
+    return int(state['turn'])
 
 #-----------------------------------------------------------------------
 
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+import os
+import glob
+import hashlib
+import tempfile
+import numpy as np
+
+# Checkpoints of a propagation so that a preempted job resumes where it
+# left off when it is resubmitted.
+#
+# Every rank saves its own particles and whatever else the caller needs
+# to continue (turn counter, partial diagnostics) as
+# <directory>/<key>/checkpoint_<rank>_<turn>.npz, written to a
+# temporary file and renamed into place. The key is a hash of the run
+# inputs, so a resubmitted job only picks up checkpoints of the same
+# run. The last two checkpoints are kept, and load() returns the newest
+# one that every rank has, so a job killed while saving still resumes.
+
+# hash of the inputs that make runs the same
+def run_key(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            h.update(np.ascontiguousarray(part).tobytes())
+        else:
+            h.update(str(part).encode())
+    return h.hexdigest()[0:16]
+
+#-----------------------------------------------------------------------
+
+class Checkpoint:
+    keep = 2
+
+    def __init__(self, directory, key, comm):
+        self.directory = os.path.join(directory, key)
+        self.rank = comm.Get_rank()
+        self.comm = comm
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, turn):
+        return os.path.join(self.directory, "checkpoint_{}_{}.npz".format(self.rank, turn))
+
+    # turns of the checkpoints of this rank, oldest first
+    def saved_turns(self):
+        turns = []
+        for fname in glob.glob(os.path.join(self.directory, "checkpoint_{}_*.npz".format(self.rank))):
+            turns.append(int(os.path.basename(fname)[:-4].rsplit('_', 1)[1]))
+        return sorted(turns)
+
+    # Returns the dict of the newest checkpoint that all ranks have,
+    # or None to start from the beginning. Collective.
+    def load(self):
+        turns = set(self.saved_turns())
+        for rank_turns in self.comm.allgather(turns):
+            turns = turns & rank_turns
+
+        state = None
+        for turn in sorted(turns, reverse=True):
+            try:
+                with np.load(self.path(turn), allow_pickle=False) as data:
+                    state = {name: data[name] for name in data.files}
+                state['turn'] = turn
+            except (OSError, ValueError, EOFError):
+                state = None
+            # every rank has to agree on the checkpoint
+            if all(self.comm.allgather(state is not None)):
+                return state
+        return None
+
+    # save the arrays given as keyword arguments for turn, then remove
+    # the older checkpoints beyond keep
+    def save(self, turn, **state):
+        fd, tmpname = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **state)
+            os.replace(tmpname, self.path(turn))
+        except BaseException:
+            try:
+                os.remove(tmpname)
+            except OSError:
+                pass
+            raise
+        for old_turn in self.saved_turns()[:-self.keep]:
+            os.remove(self.path(old_turn))
+
+    # remove the checkpoints of this rank once the run is complete
+    def remove(self):
+        for turn in self.saved_turns():
+            os.remove(self.path(turn))
+        try:
+            os.rmdir(self.directory)
+        except OSError:
+            # other ranks still have files there
+            pass
+
+#-----------------------------------------------------------------------
+
+# the local particles of bunch including their IDs
+def get_particle_state(bunch):
+    bunch.checkout_particles()
+    lp = bunch.get_particles_numpy()
+    nlocal = bunch.get_local_num()
+    return np.array(lp[:nlocal, 0:7])
+
+# put back particles saved by get_particle_state() into a bunch with
+# the same distribution over the ranks
+def set_particle_state(bunch, particles):
+    bunch.checkout_particles()
+    lp = bunch.get_particles_numpy()
+    nlocal = bunch.get_local_num()
+    if nlocal != particles.shape[0]:
+        raise RuntimeError("checkpoint has {} particles on this rank, bunch has {}".format(
+            particles.shape[0], nlocal))
+    lp[:nlocal, 0:7] = particles
+    bunch.checkin_particles()
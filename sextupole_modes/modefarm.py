@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+import os
+import json
+
+import synergia
+from modejob_options import opts
+
+import rr_modes
+import mpi4py.MPI as MPI
+
+# Farm mode for sextupole mode runs: one mpirun does many run_modes()
+# settings. The world communicator is split into groups of
+# farm_group_size ranks, the groups take the settings in turn (setting
+# i goes to group i % ngroups) and each setting runs in its own
+# directory farm_point_<i> under scratch. World rank 0 collects which
+# runs completed into farm_summary.json.
+#
+# farm_points is a JSON list of settings, each a dict with the run_modes()
+# arguments "params" and optionally "correctors", "target" and "offset":
+#
+#    [{"params": {"MPS212AU": 0.5}},
+#     {"params": {"MPS212AU": 0.5}, "correctors": ["h210", "h212", "h214"],
+#      "target": "hp212", "offset": 0.005}]
+#
+#    mpirun -np 32 python modefarm.py --farm_group_size=2 --farm_points=points.json
+
+def main():
+    world = MPI.COMM_WORLD
+    group_size = opts.farm_group_size
+    if world.Get_size() % group_size != 0:
+        raise RuntimeError(f'{world.Get_size()} ranks do not divide into groups of {group_size}')
+    group = world.rank // group_size
+    ngroups = world.Get_size() // group_size
+
+    group_comm = world.Split(group, world.rank)
+    rr_modes.set_comm(group_comm, synergia.utils.Commxx().split(group, world.rank))
+
+    with open(opts.farm_points, 'r') as f:
+        points = json.load(f)
+    scratch = os.path.abspath(opts.scratch)
+
+    runs = []
+    for index in range(group, len(points), ngroups):
+        point = points[index]
+        workdir = os.path.join(scratch, f'farm_point_{index}')
+        os.makedirs(workdir, exist_ok=True)
+        os.chdir(workdir)
+        complete = rr_modes.run_modes(point['params'], turns=opts.turns,
+                                      correctors=point.get('correctors'), target=point.get('target'),
+                                      offset=point.get('offset'),
+                                      checkpoint_period=opts.checkpoint_period, max_turns=opts.max_turns,
+                                      checkpoint_dir=os.path.join(workdir, 'checkpoint'))
+        runs.append({'index': index, 'complete': complete, 'directory': workdir})
+
+    # the group leaders report for their group
+    if group_comm.rank != 0:
+        runs = []
+    gathered = world.gather(runs, root=0)
+    if world.rank == 0:
+        summary = sorted([run for group_runs in gathered for run in group_runs], key=lambda run: run['index'])
+        with open(os.path.join(scratch, 'farm_summary.json'), 'w') as f:
+            json.dump(summary, f, indent=1)
+        print(f'farm: {sum(1 for run in summary if run["complete"])} of {len(summary)} runs complete')
+
+if __name__ == "__main__":
+    main()
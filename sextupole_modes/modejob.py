@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+import os
 import synergia
 from modejob_options import opts
 
@@ -42,7 +43,11 @@ def main():
             raise RuntimeError('orbit bump corrector elements are defined but no offset or target element')
         pass
 
-    run_modes(params, turns=turns, correctors=correctors, target=target, offset=offset)
+    complete = run_modes(params, turns=turns, correctors=correctors, target=target, offset=offset,
+                         checkpoint_period=opts.checkpoint_period, max_turns=opts.max_turns,
+                         checkpoint_dir=os.path.join(opts.scratch, 'checkpoint'))
+    if not complete and myrank == 0:
+        print('run incomplete, resubmit the job to continue from the last checkpoint')
 
     pass
 
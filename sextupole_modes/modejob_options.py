@@ -13,5 +13,10 @@ opts.add('offset', 0.0, 'offset for orbit bump at target element')
 opts.add('adjelem', None, 'element name for k2l adjustment', str)
 opts.add('adjk2l', 0.0, 'value of k2l setting for element')
 opts.add('turns', 2048, 'Number of turns for simulation')
+opts.add('checkpoint_period', 0, 'checkpoint every n turns, 0 for no checkpoints', int)
+opts.add('max_turns', None, 'maximum number of turns this run, resubmit to continue', int)
+opts.add('scratch', '.', 'directory for the checkpoints', str)
+opts.add('farm_group_size', 1, 'MPI ranks per group for modefarm.py', int)
+opts.add('farm_points', 'farm_points.json', 'JSON file with the list of settings for modefarm.py', str)
 
-job_mgr = synergia_workflow.Job_manager("modejob.py", opts, ['../RR2020V0922FLAT_k2l_template_NoBreaks_K2L_ready', 'rr_modes.py', 'rr_setup.py', 'rrnova_qt60x.py', 'rr_sextupoles.py', 'three_bump.py', 'sext_names.pickle'])
+job_mgr = synergia_workflow.Job_manager("modejob.py", opts, ['../RR2020V0922FLAT_k2l_template_NoBreaks_K2L_ready', 'rr_modes.py', 'rr_setup.py', 'rrnova_qt60x.py', 'rr_sextupoles.py', 'three_bump.py', 'checkpoint.py', 'modefarm.py', 'sext_names.pickle'])
@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 import sys, os
+import glob
 import pickle
+import h5py
 import numpy as np
 import re
 
@@ -9,15 +11,23 @@ import synergia.simulation as SIM
 ET = synergia.lattice.element_type
 
 import mpi4py.MPI as MPI
-myrank = MPI.COMM_WORLD.rank
+
+# The ranks the run is on, all of them unless set_comm() is called
+# (see modefarm.py). commxx is the synergia communicator over the same
+# ranks, None for the synergia default.
+comm = MPI.COMM_WORLD
+commxx = None
+myrank = comm.rank
 
 import rr_setup
 import rrnova_qt60x
 import rr_sextupoles
 
+import three_bump
 from three_bump import Three_bump
+import checkpoint
 
-lattice_file = '../RR2020V0922FLAT_k2l_template_NoBreaks_K2L_ready'
+lattice_file = os.path.abspath('../RR2020V0922FLAT_k2l_template_NoBreaks_K2L_ready')
 RR_line = "ring605_fodo"
 
 RR_xtune = 0.42
@@ -35,6 +45,17 @@ with open('sext_names.pickle', 'rb') as f:
 
 
 
+#------------------------------------------------------------------------
+
+# run on the ranks of the mpi4py communicator mpi_comm, with synergia_comm
+# the synergia communicator over the same ranks
+def set_comm(mpi_comm, synergia_comm):
+    global comm, commxx, myrank
+    comm = mpi_comm
+    commxx = synergia_comm
+    myrank = comm.rank
+    three_bump.sim_commxx = synergia_comm
+
 #------------------------------------------------------------------------
 
 # Edit the multipole moment parameters 
@@ -89,7 +110,10 @@ def prepare_lattice(params):
 def create_simulator(refpart, kick):
     macroparticles = 8
     realparticles = 5e10
-    sim = SIM.Bunch_simulator.create_single_bunch_simulator(refpart, macroparticles, realparticles)
+    if commxx is None:
+        sim = SIM.Bunch_simulator.create_single_bunch_simulator(refpart, macroparticles, realparticles)
+    else:
+        sim = SIM.Bunch_simulator.create_single_bunch_simulator(refpart, macroparticles, realparticles, commxx)
     # populate the bunch. Particle 0 stays as 0, particle 1 has kick in px
     # particle 2 has kick in py.
     bunch = sim.get_bunch(0, 0)
@@ -163,9 +187,15 @@ def get_BPMs_and_lattice_functions(lattice):
 #------------------------------------------------------------------------
 
 
-def register_diagnostics(sim, lattice):
+# When checkpointing, each job writes a segment file per BPM starting at
+# the turn it resumed from, BPM_<name>_seg<turn>.h5, and the segments
+# are merged into BPM_<name>.h5 at the end (see merge_bpm_segments()).
+# Returns the BPM names.
+
+def register_diagnostics(sim, lattice, segment=None):
     # Go through the lattice and register a diagnostic for each
     # BPM device which are (H|P)[1-6][0-9][0-9] monitors/instruments
+    bpm_names = []
     bpm_patt =  re.compile('(h|v)p[1-6][0-9][0-9]')
     for elem in lattice.get_elements():
         et = elem.get_type()
@@ -173,8 +203,57 @@ def register_diagnostics(sim, lattice):
             ename = elem.get_name()
             mo = bpm_patt.fullmatch(ename)
             if mo:
-                diag = synergia.bunch.Diagnostics_bulk_track(f'BPM_{ename}.h5', 4)
+                if segment is None:
+                    diag = synergia.bunch.Diagnostics_bulk_track(f'BPM_{ename}.h5', 4)
+                else:
+                    diag = synergia.bunch.Diagnostics_bulk_track(f'BPM_{ename}_seg{segment:06d}.h5', 4)
                 sim.reg_diag_at_element(diag, elem)
+                bpm_names.append(ename)
+    return bpm_names
+
+#------------------------------------------------------------------------
+
+# segment files of a BPM as a list of (start turn, filename)
+def get_bpm_segments(ename):
+    segments = []
+    for fname in glob.glob(f'BPM_{ename}_seg*.h5'):
+        segments.append((int(fname[:-3].rsplit('_seg', 1)[1]), fname))
+    return sorted(segments)
+
+# remove the segments from turn on, which a resumed job writes again
+def remove_bpm_segments(bpm_names, turn):
+    for ename in bpm_names:
+        for (start, fname) in get_bpm_segments(ename):
+            if start >= turn:
+                os.remove(fname)
+
+# Join the segments of each BPM into BPM_<name>.h5. A segment may go on
+# past the checkpoint the next job resumed from, so each one only
+# contributes the turns up to the start of the next. Datasets with one
+# entry per turn are joined, the others are taken from the first segment.
+def merge_bpm_segments(bpm_names, turns):
+    for ename in bpm_names:
+        segments = get_bpm_segments(ename)
+        ends = [start for (start, fname) in segments[1:]] + [turns]
+        with h5py.File(f'BPM_{ename}.h5', 'w') as out:
+            for ((start, fname), end) in zip(segments, ends):
+                with h5py.File(fname, 'r') as seg:
+                    nrows = seg['track_coords'].shape[0]
+                    for name, dset in seg.items():
+                        data = dset[()]
+                        if np.ndim(data) == 0 or data.shape[0] != nrows:
+                            if name not in out:
+                                out[name] = data
+                            continue
+                        rows = data[0:end-start]
+                        if name not in out:
+                            out.create_dataset(name, data=rows, maxshape=(None,)+data.shape[1:])
+                        else:
+                            n = out[name].shape[0]
+                            out[name].resize(n+rows.shape[0], axis=0)
+                            out[name][n:] = rows
+        for (start, fname) in segments:
+            os.remove(fname)
 
 #------------------------------------------------------------------------
 
@@ -184,7 +263,14 @@ def register_diagnostics(sim, lattice):
 # params['MPS109AD'] = -99.0
 # params['MP100AS'] = 3.14159
 
-def run_modes(params, turns=2048, correctors=None, target=None, offset=None):
+# If checkpoint_period is given, the particles are saved to
+# checkpoint_dir every checkpoint_period turns and a rerun with the same
+# settings resumes from the last checkpoint. max_turns limits the turns
+# propagated by this run so a job fits a short queue slot. Returns True
+# once all the turns are done, False if the job has to be resubmitted.
+
+def run_modes(params, turns=2048, correctors=None, target=None, offset=None,
+              checkpoint_period=None, max_turns=None, checkpoint_dir='checkpoint'):
 
     # start with getting the lattice set up to use the requested
     # settings.
@@ -225,8 +311,24 @@ def run_modes(params, turns=2048, correctors=None, target=None, offset=None):
     # create the bunch simulator with the initial kick
     sim = create_simulator(lattice.get_reference_particle(), kick = 0.001)
 
+    turn = 0
+    if checkpoint_period:
+        ckpt = checkpoint.Checkpoint(checkpoint_dir,
+                                     checkpoint.run_key(lattice.as_json(), turns, comm.Get_size()), comm)
+        state = ckpt.load()
+        if state is not None:
+            checkpoint.set_particle_state(sim.get_bunch(), state['particles'])
+            turn = int(state['turn'])
+            if myrank == 0:
+                print("resuming from checkpoint at turn ", turn)
+
     # register the diagnostics. I'll try to go with bulk track for 4 particles
-    register_diagnostics(sim, lattice)
+    if checkpoint_period:
+        bpm_names = register_diagnostics(sim, lattice, segment=turn)
+        if myrank == 0:
+            remove_bpm_segments(bpm_names, turn+1)
+    else:
+        register_diagnostics(sim, lattice)
 
     # Stepper and propagator.
     # For these sextupole modes I don't need space charge at the moment
@@ -235,11 +337,35 @@ def run_modes(params, turns=2048, correctors=None, target=None, offset=None):
     simlog = synergia.utils.parallel_utils.Logger(0, 
             synergia.utils.parallel_utils.LoggerV.INFO_TURN)
 
-    propagator.propagate(sim, simlog, turns)
-
-    return
-
-    return
+    if not checkpoint_period and not max_turns:
+        propagator.propagate(sim, simlog, turns)
+        return True
+
+    # propagate() continues from the turn the simulator is at
+    last_turn = turns
+    if max_turns:
+        last_turn = min(turns, turn + max_turns)
+    while turn < last_turn:
+        nturns = last_turn - turn
+        if checkpoint_period:
+            nturns = min(nturns, checkpoint_period - turn % checkpoint_period)
+        propagator.propagate(sim, simlog, nturns)
+        turn = turn + nturns
+        if checkpoint_period and turn < turns and (turn % checkpoint_period == 0 or turn == last_turn):
+            ckpt.save(turn, particles=checkpoint.get_particle_state(sim.get_bunch()))
+
+    if turn < turns:
+        if myrank == 0:
+            print("stopping at turn ", turn, " of ", turns, ", resubmit to continue")
+        return False
+
+    if checkpoint_period:
+        comm.Barrier()
+        if myrank == 0:
+            merge_bpm_segments(bpm_names, turns)
+        ckpt.remove()
+
+    return True
 
 #------------------------------------------------------------------------
 
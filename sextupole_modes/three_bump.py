@@ -7,6 +7,10 @@ import numpy as np
 import h5py
 from scipy.optimize import least_squares
 
+# synergia communicator for the bump propagation, None for the default of
+# all ranks (see rr_modes.set_comm())
+sim_commxx = None
+
 # class that calculates corrector settings to create a 3 kick local orbit bump
 class Three_bump:
 
@@ -179,7 +183,10 @@ class Three_bump:
         comm = synergia.utils.Commxx()
         refpart = self.bump_lattice.get_reference_particle()
 
-        sim = synergia.simulation.Bunch_simulator.create_single_bunch_simulator(refpart, 8, 0.5e11)
+        if sim_commxx is None:
+            sim = synergia.simulation.Bunch_simulator.create_single_bunch_simulator(refpart, 8, 0.5e11)
+        else:
+            sim = synergia.simulation.Bunch_simulator.create_single_bunch_simulator(refpart, 8, 0.5e11, sim_commxx)
         bunch = sim.get_bunch(0, 0)
         lp = bunch.get_particles_numpy()
         lp[:, 0:6] = 0.0
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+import time
+import json
+import resource
+import contextlib
+
+# Wall and CPU time spent in the named stages of an evaluation, plus
+# counters and the peak resident set size. Code marks its stages with
+#
+#    with stage_timing.stage("propagation"):
+#        ...
+#
+# which costs nothing unless a record is being made by recording().
+# Time spent in the same stage more than once is accumulated.
+
+class Stage_record:
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
+        self.start_time = time.time()
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.start_rss = current_rss_mb()
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.rss = self.start_rss
+
+    def add(self, name, wall, cpu):
+        if name not in self.stages:
+            self.stages[name] = {'wall': 0.0, 'cpu': 0.0, 'calls': 0}
+        self.stages[name]['wall'] = self.stages[name]['wall'] + wall
+        self.stages[name]['cpu'] = self.stages[name]['cpu'] + cpu
+        self.stages[name]['calls'] = self.stages[name]['calls'] + 1
+
+    def finish(self):
+        self.wall = time.perf_counter() - self.start_wall
+        self.cpu = time.process_time() - self.start_cpu
+        self.rss = current_rss_mb()
+
+    def as_dict(self):
+        return {
+            'time': self.start_time,
+            'wall': self.wall,
+            'cpu': self.cpu,
+            'peak_rss_mb': peak_rss_mb(),
+            'rss_mb': self.rss,
+            'rss_growth_mb': self.rss - self.start_rss,
+            'stages': self.stages,
+            'counters': self.counters,
+        }
+
+#-----------------------------------------------------------------------
+
+# the record being made, if any
+active_record = None
+
+@contextlib.contextmanager
+def recording():
+    global active_record
+    previous = active_record
+    active_record = Stage_record()
+    try:
+        yield active_record
+    finally:
+        active_record.finish()
+        active_record = previous
+
+@contextlib.contextmanager
+def stage(name):
+    record = active_record
+    if record is None:
+        yield
+        return
+    wall0 = time.perf_counter()
+    cpu0 = time.process_time()
+    try:
+        yield
+    finally:
+        record.add(name, time.perf_counter() - wall0, time.process_time() - cpu0)
+
+def count(name, value):
+    if active_record is not None:
+        active_record.counters[name] = value
+
+#-----------------------------------------------------------------------
+
+# peak resident set size of this process in MB (ru_maxrss is in kB on
+# Linux)
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+# current resident set size of this process in MB, from /proc where
+# there is one, otherwise the peak
+def current_rss_mb():
+    try:
+        with open("/proc/self/statm", 'r') as f:
+            pages = int(f.read().split()[1])
+    except OSError:
+        return peak_rss_mb()
+    return pages * resource.getpagesize() / (1024.0*1024.0)
+
+# append a record as one line of JSON
+def append_jsonl(filename, record):
+    with open(filename, 'a') as f:
+        print(json.dumps(record), file=f)
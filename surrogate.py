@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+
+import time
+import numpy as np
+
+import evaluate
+import rr_tune_survey
+import result_cache
+from rr_options import opts
+
+# Surrogate model of the tune curves for screening optimizer candidates.
+#
+# The tune vector of an evaluation (the x tunes at every survey offset
+# followed by the y tunes, 82 values) varies smoothly with the knob
+# vector. The tune vectors of the stored evaluations are reduced to
+# their leading principal components, keeping all but a fraction
+# surrogate_pca_tol of the variance, and each component is modelled as
+# a Gaussian process of the knob vector. All the components share a
+# squared exponential kernel on the standardized knobs, with the length
+# scale and nugget that maximize the summed marginal likelihood, so the
+# inverse Cholesky factor of the kernel matrix is computed once and a
+# prediction is a couple of small matrix products.
+#
+# New evaluations are added without refitting: the inverse Cholesky
+# factor is extended by blocks and the new tune vectors are projected on
+# the existing components. After surrogate_refit_period additions the
+# components and the kernel are fitted again.
+
+# length scales and nuggets tried when fitting the kernel
+length_scales = (0.5, 1.0, 2.0, 4.0, 8.0, 16.0)
+nuggets = (1.0e-10, 1.0e-8, 1.0e-6, 1.0e-4)
+
+#-----------------------------------------------------------------------
+
+# The knob vectors and tune vectors of the stable evaluations in the
+# result cache directory cache_dir made with adjust_tunes, mode and
+# fidelity, and the knob vectors of the unstable ones. Returns (keys,
+# kxl, tunes, unstable_keys, unstable_kxl). Entries that do not record
+# their settings are left out.
+
+def load_cache_data(cache_dir, fidelity="full", adjust_tunes=True, mode="track"):
+    cache = result_cache.Result_cache(cache_dir, opts.cache_max_mb*1024*1024)
+    noffsets = len(rr_tune_survey.get_dpop_offsets())
+    keys = []
+    kxl = []
+    tunes = []
+    unstable_keys = []
+    unstable_kxl = []
+    for (key, entry) in cache.items():
+        if 'kxl' not in entry or 'adjust_tunes' not in entry or 'mode' not in entry:
+            continue
+        if (entry.get('fidelity', "full") != fidelity or bool(entry['adjust_tunes']) != adjust_tunes or
+                entry['mode'] != mode):
+            continue
+        if entry['status'] != 'ok':
+            unstable_keys.append(key)
+            unstable_kxl.append(entry['kxl'])
+        elif len(entry['xtunes']) == noffsets:
+            keys.append(key)
+            kxl.append(entry['kxl'])
+            tunes.append(np.concatenate((entry['xtunes'], entry['ytunes'])))
+    return (keys, np.array(kxl).reshape(-1, len(rr_tune_survey.knob_names)), np.array(tunes),
+            unstable_keys, np.array(unstable_kxl).reshape(-1, len(rr_tune_survey.knob_names)))
+
+#-----------------------------------------------------------------------
+
+class Tune_surrogate:
+    def __init__(self, pca_tol=None, refit_period=None):
+        self.pca_tol = opts.surrogate_pca_tol if pca_tol is None else pca_tol
+        self.refit_period = opts.surrogate_refit_period if refit_period is None else refit_period
+        self.kxl = np.zeros((0, len(rr_tune_survey.knob_names)))
+        self.tunes = None
+        self.unstable_kxl = np.zeros((0, len(rr_tune_survey.knob_names)))
+        self.keys = set()
+        self.pending = 0
+        self.fitted = False
+
+    # squared exponential kernel between the standardized knob vectors
+    # u of shape (m, knobs) and v of shape (n, knobs)
+    def kernel(self, u, v, length_scale):
+        d2 = np.sum(u**2, axis=1)[:, np.newaxis] + np.sum(v**2, axis=1)[np.newaxis, :] - 2.0*u @ v.T
+        return np.exp(-0.5*np.maximum(d2, 0.0)/length_scale**2)
+
+    def standardize(self, kxl):
+        return (kxl - self.kxl_mean) / self.kxl_scale
+
+    # Fit the principal components and the kernel to all the stored
+    # evaluations.
+    def fit(self):
+        n = self.kxl.shape[0]
+        if n < 2:
+            raise RuntimeError("Tune_surrogate: {} stable evaluations is too few to fit".format(n))
+
+        self.kxl_mean = np.mean(self.kxl, axis=0)
+        self.kxl_scale = np.std(self.kxl, axis=0)
+        self.kxl_scale[self.kxl_scale == 0.0] = 1.0
+        x = self.standardize(self.kxl)
+
+        self.tunes_mean = np.mean(self.tunes, axis=0)
+        (u, sv, vt) = np.linalg.svd(self.tunes - self.tunes_mean, full_matrices=False)
+        variance = sv**2
+        left = 1.0 - np.cumsum(variance)/max(np.sum(variance), np.finfo(float).tiny)
+        ncomp = int(np.argmax(left <= self.pca_tol)) + 1
+        self.components = vt[:ncomp]
+        # rms of the variance left out, in each tune
+        self.truncation = np.sqrt(np.sum((variance[ncomp:, np.newaxis]*vt[ncomp:]**2), axis=0)/n)
+        z = (self.tunes - self.tunes_mean) @ self.components.T
+
+        best = None
+        for length_scale in length_scales:
+            k = self.kernel(x, x, length_scale)
+            for nugget in nuggets:
+                try:
+                    chol = np.linalg.cholesky(k + nugget*np.identity(n))
+                except np.linalg.LinAlgError:
+                    continue
+                w = np.linalg.solve(chol, z)
+                signal = np.sum(w**2, axis=0)/n
+                loglike = -0.5*n*np.sum(np.log(np.maximum(signal, np.finfo(float).tiny))) \
+                    - ncomp*np.sum(np.log(np.diag(chol)))
+                if best is None or loglike > best[0]:
+                    best = (loglike, length_scale, nugget)
+        if best is None:
+            raise RuntimeError("Tune_surrogate: no kernel could be fitted")
+
+        (loglike, self.length_scale, self.nugget) = best
+        chol = np.linalg.cholesky(self.kernel(x, x, self.length_scale) + self.nugget*np.identity(n))
+        self.linv = np.linalg.inv(chol)
+        self.update_weights(z)
+        self.pending = 0
+        self.fitted = True
+
+    # the GP weights and signal variance of the component values z of
+    # the stored evaluations
+    def update_weights(self, z):
+        self.z = z
+        w = self.linv @ z
+        self.alpha = self.linv.T @ w
+        self.signal = np.sum(w**2, axis=0)/z.shape[0]
+
+    # Add evaluations with knob vectors kxl, shape (m, knobs), and tune
+    # vectors tunes, shape (m, 82). Until the next refit the kernel and
+    # the components are kept and the inverse Cholesky factor is
+    # extended.
+    def add(self, kxl, tunes):
+        kxl = np.atleast_2d(kxl)
+        tunes = np.atleast_2d(tunes)
+        if len(kxl) == 0:
+            return
+        old = self.kxl
+        self.kxl = np.concatenate((self.kxl, kxl))
+        self.tunes = tunes.copy() if self.tunes is None else np.concatenate((self.tunes, tunes))
+        self.pending = self.pending + len(kxl)
+        if not self.fitted or self.pending >= self.refit_period:
+            if self.kxl.shape[0] >= 2:
+                self.fit()
+            return
+
+        # Cholesky factor of [[K, B], [B^T, C]] is [[L, 0], [W^T, S]]
+        # with W = L^-1 B and S S^T = C - W^T W
+        x_new = self.standardize(kxl)
+        b = self.kernel(self.standardize(old), x_new, self.length_scale)
+        c = self.kernel(x_new, x_new, self.length_scale) + self.nugget*np.identity(len(kxl))
+        w = self.linv @ b
+        try:
+            s_inv = np.linalg.inv(np.linalg.cholesky(c - w.T @ w))
+        except np.linalg.LinAlgError:
+            # the new points are too close to the old ones for the
+            # nugget, start over
+            self.fit()
+            return
+        self.linv = np.block([[self.linv, np.zeros((len(old), len(kxl)))], [-s_inv @ w.T @ self.linv, s_inv]])
+        self.update_weights(np.concatenate((self.z, (tunes - self.tunes_mean) @ self.components.T)))
+
+    # add unstable evaluations, which screening avoids
+    def add_unstable(self, kxl):
+        self.unstable_kxl = np.concatenate((self.unstable_kxl, np.atleast_2d(kxl)))
+
+    # Add the entries of the result cache directory cache_dir made with
+    # fidelity, adjust_tunes and mode that are not in the model yet.
+    def update_from_cache(self, cache_dir, fidelity="full", adjust_tunes=True, mode="track"):
+        (keys, kxl, tunes, unstable_keys, unstable_kxl) = load_cache_data(cache_dir, fidelity, adjust_tunes, mode)
+        new = [k for k, key in enumerate(keys) if key not in self.keys]
+        new_unstable = [k for k, key in enumerate(unstable_keys) if key not in self.keys]
+        self.keys.update(keys)
+        self.keys.update(unstable_keys)
+        self.add_unstable(unstable_kxl[new_unstable])
+        self.add(kxl[new], tunes[new])
+
+    # Predicted tune vectors of the knob vectors kxl, shape (m, knobs),
+    # and their standard deviations, both of shape (m, 82).
+    def predict(self, kxl):
+        if not self.fitted:
+            raise RuntimeError("Tune_surrogate: not fitted")
+        kstar = self.kernel(self.standardize(np.atleast_2d(kxl)), self.standardize(self.kxl), self.length_scale)
+        mean = self.tunes_mean + (kstar @ self.alpha) @ self.components
+        reduction = np.sum((kstar @ self.linv.T)**2, axis=1)
+        variance = np.maximum(1.0 + self.nugget - reduction, 0.0)[:, np.newaxis]*self.signal
+        std = np.sqrt(variance @ self.components**2 + self.truncation**2)
+        return (mean, std)
+
+    # Decide which candidate knob vectors kxl are worth full tracking:
+    # those whose optimistic residual norm against the measured tunes,
+    # the predicted norm less kappa standard deviations, is below the
+    # best norm evaluated so far, and those whose predicted tunes are
+    # uncertain by more than uncertainty_tol (rms over the tunes).
+    # Candidates whose nearest evaluated neighbour was unstable are only
+    # picked for their uncertainty. Returns a dict of arrays over the
+    # candidates.
+    def screen(self, kxl, kappa=None, uncertainty_tol=None):
+        kappa = opts.surrogate_kappa if kappa is None else kappa
+        uncertainty_tol = opts.surrogate_uncertainty_tol if uncertainty_tol is None else uncertainty_tol
+        kxl = np.atleast_2d(kxl)
+        measured = evaluate.get_measured_tunes()
+        measured = np.concatenate((measured[:, 0], measured[:, 1]))
+
+        (mean, std) = self.predict(kxl)
+        residual = np.sqrt(np.sum((mean - measured)**2, axis=1))
+        uncertainty = np.sqrt(np.mean(std**2, axis=1))
+        best = np.min(np.sqrt(np.sum((self.tunes - measured)**2, axis=1)))
+
+        likely_unstable = np.zeros(len(kxl), dtype=bool)
+        if len(self.unstable_kxl):
+            x = self.standardize(kxl)
+            stable_dist = np.min(np.sum((x[:, np.newaxis] - self.standardize(self.kxl))**2, axis=2), axis=1)
+            unstable_dist = np.min(np.sum((x[:, np.newaxis] - self.standardize(self.unstable_kxl))**2, axis=2),
+                                   axis=1)
+            likely_unstable = unstable_dist < stable_dist
+
+        promising = (residual - kappa*np.sqrt(np.sum(std**2, axis=1)) < best) & np.logical_not(likely_unstable)
+        uncertain = uncertainty > uncertainty_tol if uncertainty_tol else np.zeros(len(kxl), dtype=bool)
+        return {
+            'predicted_residual': residual,
+            'uncertainty': uncertainty,
+            'likely_unstable': likely_unstable,
+            'promising': promising,
+            'uncertain': uncertain,
+            'selected': promising | uncertain,
+        }
+
+#-----------------------------------------------------------------------
+
+# A Tune_surrogate fitted to the entries of the result cache
+# opts.cache_dir made with fidelity, adjust_tunes and mode.
+def from_cache(fidelity="full", adjust_tunes=True, mode="track"):
+    if not opts.cache_dir:
+        raise RuntimeError("surrogate: the cache_dir option is not set")
+    model = Tune_surrogate()
+    model.update_from_cache(opts.cache_dir, fidelity, adjust_tunes, mode)
+    if not model.fitted:
+        model.fit()
+    return model
+
+# Screen the list of kxl_values dicts with model and evaluate only the
+# selected ones with evaluate_many() with adjust_tunes, mode and
+# fidelity, which should be the settings model was fitted for. The new
+# results are added to model, and their cache keys to model.keys so
+# update_from_cache() does not add them again. Returns the screen dict and a list with
+# the Evaluation of every selected candidate and None for the others.
+
+def evaluate_screened(model, kxl_list, workers=None, adjust_tunes=True, mode="track", fidelity="full", kappa=None,
+                      uncertainty_tol=None):
+    kxl = np.array([evaluate.get_knob_vector(kxl_values) for kxl_values in kxl_list])
+    t0 = time.time()
+    screen = model.screen(kxl, kappa, uncertainty_tol)
+    screen['screen_wall'] = time.time() - t0
+
+    selected = np.nonzero(screen['selected'])[0]
+    results = [None]*len(kxl_list)
+    if len(selected):
+        selected_results = evaluate.evaluate_many([kxl_list[k] for k in selected], workers, adjust_tunes, mode,
+                                                  fidelity)
+        for k, result in zip(selected, selected_results):
+            results[k] = result
+        # an incomplete result is not cached, so it is left for a later
+        # update_from_cache() along with its key
+        done = [k for k in selected if results[k].status != 'incomplete']
+        model.keys.update(evaluate.evaluation_key(kxl_list[k], adjust_tunes, mode, fidelity) for k in done)
+        ok = [k for k in done if results[k].ok]
+        if ok:
+            model.add(kxl[ok], np.array([np.concatenate((results[k][0], results[k][1])) for k in ok]))
+        model.add_unstable(kxl[[k for k in done if not results[k].ok]])
+    return (screen, results)
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+import time
+import itertools
+import numpy as np
+
+import rr_tune_survey
+import tune_suite
+
+# One-turn polynomial (Taylor) map of the ring for fast tune surveys.
+#
+# The map is extracted once per lattice by tracking a cloud of sample
+# particles one turn with synergia and fitting every output coordinate
+# with a polynomial of the chosen order in the input coordinates. It is
+# then applied to all the particles at once for every turn. With the RF
+# off, cdt never feeds back into the other coordinates, so the map
+# depends only on x, x', y, y' and dp/p.
+
+# coordinates the one-turn map depends on
+map_variables = (0, 1, 2, 3, 5)
+
+# smallest half width of the fitted region for each of map_variables
+map_min_scales = (1.0e-3, 1.0e-4, 1.0e-3, 1.0e-4, 1.0e-4)
+
+# the number of sample particles is this times the number of monomials
+samples_per_term = 4
+
+#-----------------------------------------------------------------------
+
+# exponents of all the monomials in nvars variables of total order up
+# to order, as an array of shape (terms, nvars) sorted by total order
+def monomial_exponents(nvars, order):
+    exponents = [e for e in itertools.product(range(order+1), repeat=nvars) if sum(e) <= order]
+    exponents.sort(key=sum)
+    return np.array(exponents, dtype=int)
+
+#-----------------------------------------------------------------------
+
+# A polynomial map out = coords + sum_k coeffs[k] * z**exponents[k],
+# where z are the coordinates in variables divided by scales. Fitting
+# the change of the coordinates keeps the coordinates that are not
+# variables (cdt) exact up to the fitted change.
+
+class Taylor_map:
+    def __init__(self, exponents, coeffs, variables, scales):
+        self.exponents = exponents
+        self.coeffs = coeffs
+        self.variables = list(variables)
+        self.scales = np.asarray(scales, dtype='d')
+        self.order = int(np.max(np.sum(exponents, axis=1)))
+
+    # values of all the monomials for coords of shape (..., 6), giving
+    # shape (..., terms), or of the monomials with exponents instead
+    def monomials(self, coords, exponents=None):
+        if exponents is None:
+            exponents = self.exponents
+        z = coords[..., self.variables] / self.scales
+        powers = np.ones(z.shape + (self.order+1,))
+        for k in range(1, self.order+1):
+            powers[..., k] = powers[..., k-1] * z
+        nvars = len(self.variables)
+        terms = powers[..., np.arange(nvars)[np.newaxis, :], exponents]
+        return np.prod(terms, axis=-1)
+
+    # the derivatives of apply() by the coordinates at coords of shape
+    # (..., 6), giving shape (..., 6, 6)
+    def jacobian(self, coords):
+        jac = np.zeros(coords.shape + (6,))
+        jac[..., np.arange(6), np.arange(6)] = 1.0
+        for j, var in enumerate(self.variables):
+            lowered = self.exponents.copy()
+            lowered[:, j] = np.maximum(lowered[:, j] - 1, 0)
+            derivatives = self.monomials(coords, lowered) * (self.exponents[:, j] / self.scales[j])
+            jac[..., :, var] += derivatives @ self.coeffs
+        return jac
+
+    def apply(self, coords):
+        return coords + self.monomials(coords) @ self.coeffs
+
+    # the linear part of the map at the origin: the derivatives of the
+    # output coordinates by the variables, shape (6, len(variables))
+    def linear_part(self):
+        nvars = len(self.variables)
+        linear = np.zeros((6, nvars))
+        for j, var in enumerate(self.variables):
+            unit = np.zeros(nvars, dtype=int)
+            unit[j] = 1
+            k = np.nonzero(np.all(self.exponents == unit, axis=1))[0][0]
+            linear[var, j] = 1.0
+            linear[:, j] += self.coeffs[k] / self.scales[j]
+        return linear
+
+    # Track coords of shape (particles, 6) for turns turns into the
+    # Track_buffer tracks, stopping if tracks sees an amplitude beyond
+    # its abort_amplitude.
+    def track(self, coords, turns, tracks):
+        ids = np.arange(coords.shape[0])
+        tracks.store(ids, coords)
+        for turn in range(turns):
+            coords = self.apply(coords)
+            tracks.store(ids, coords)
+            if tracks.abort_reason:
+                break
+        return tracks
+
+    # least squares fit to the sample particles coords_in that went to
+    # coords_out, both of shape (samples, 6), with all the monomials up
+    # to order or only those in exponents
+    @classmethod
+    def fit(cls, coords_in, coords_out, order, variables, scales, exponents=None):
+        if exponents is None:
+            exponents = monomial_exponents(len(variables), order)
+        fitmap = cls(exponents, np.zeros((len(exponents), 6)), variables, scales)
+        a = fitmap.monomials(coords_in)
+        if a.shape[0] < a.shape[1]:
+            raise RuntimeError("Taylor_map.fit: {} samples for {} terms".format(a.shape[0], a.shape[1]))
+        fitmap.coeffs = np.linalg.lstsq(a, coords_out - coords_in, rcond=None)[0]
+        return fitmap
+
+#-----------------------------------------------------------------------
+
+# Half widths of the region to fit the map over: twice the largest
+# excursion of the coordinates coords, but no less than map_min_scales.
+
+def get_fit_scales(coords):
+    return np.maximum(2.0*np.max(np.abs(coords[:, list(map_variables)]), axis=0), map_min_scales)
+
+#-----------------------------------------------------------------------
+
+# sample particles to fit a map of order to, uniformly distributed over
+# the region given by scales
+def get_samples(order, scales, seed):
+    nterms = len(monomial_exponents(len(map_variables), order))
+    rng = np.random.default_rng(seed)
+    samples = np.zeros((samples_per_term*nterms, 6))
+    samples[:, list(map_variables)] = rng.uniform(-1.0, 1.0, (samples.shape[0], len(map_variables))) * scales
+    return samples
+
+# Extract the one-turn map of lattice to order by tracking sample
+# particles uniformly distributed over the region given by scales
+# for one turn.
+
+def get_one_turn_map(lattice, order, scales, seed=4):
+    samples = get_samples(order, scales, seed)
+    tracks = rr_tune_survey.run_rr(lattice, 1, coords=samples)
+    coords_out = tracks.get_tracks()[1]
+
+    return Taylor_map.fit(samples, coords_out, order, map_variables, scales)
+
+#-----------------------------------------------------------------------
+
+# The tune survey of rr_tune_survey.run_rr() done with the one-turn map
+# of lattice instead of element by element tracking. Returns the
+# Track_buffer with the tracks.
+
+def run_map(lattice, turns, order, abort_amplitude=None, coords=None):
+    if coords is None:
+        coords = rr_tune_survey.get_initial_coords(lattice, rr_tune_survey.get_dpop_offsets())
+
+    one_turn_map = get_one_turn_map(lattice, order, get_fit_scales(coords))
+
+    tracks = rr_tune_survey.Track_buffer(turns, coords.shape[0], abort_amplitude)
+    return one_turn_map.track(coords, turns, tracks)
+
+#-----------------------------------------------------------------------
+
+# Compare the tunes from map tracking with the tunes from element by
+# element tracking of the survey particles for turns turns. Returns a
+# dict with the largest tune differences and the time per turn of both.
+
+def validate_map(lattice, turns, order):
+    t0 = time.time()
+    element_tracks = rr_tune_survey.run_rr(lattice, turns).get_tracks()
+    t1 = time.time()
+    map_tracks = run_map(lattice, turns, order).get_tracks()
+    t2 = time.time()
+
+    element_tunes = tune_suite.batch_interp_tunes(element_tracks)
+    map_tunes = tune_suite.batch_interp_tunes(map_tracks)
+    dtunes = np.abs(map_tunes - element_tunes)
+
+    return {
+        'order': order,
+        'turns': turns,
+        'max_dxtune': np.max(dtunes[:, 0]),
+        'max_dytune': np.max(dtunes[:, 1]),
+        'element_turn_time': (t1 - t0)/turns,
+        'map_turn_time': (t2 - t1)/turns,
+    }
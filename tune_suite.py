@@ -80,6 +80,59 @@ def interp_tunes(coords, search_range=((0.0,0.5),(0.0,0.5),(0.0,0.5))):
     
 
 
+# get interpolated tunes of many particles at once
+def batch_interp_tunes(trks, planes=(0, 2)):
+    # trks has shape (n, particles, 6), planes are the coordinate indices
+    # to analyze. Gives the same tunes as interp_tunes with one real FFT
+    # along the turn axis for all the particles and planes.
+    # Returns an array of shape (particles, len(planes)).
+    n = trks.shape[0]
+    maxn = int(n/2)
+    xt = np.abs(np.fft.rfft(trks[:, :, list(planes)], axis=0))
+    # cut off low end
+    xt[0:10] = 0.0
+    locmax = np.argmax(xt[0:maxn], axis=0)
+    xtp = np.take_along_axis(xt, locmax[np.newaxis], axis=0)[0]
+    xtlo = np.take_along_axis(xt, np.maximum(locmax-1, 0)[np.newaxis], axis=0)[0]
+    xthi = np.take_along_axis(xt, (locmax+1)[np.newaxis], axis=0)[0]
+    lower = xtlo > xthi
+    dir = np.where(lower, -1.0, 1.0)
+    xtp2 = np.where(lower, xtlo, xthi)
+
+    return locmax/n + dir*(xtp2/(xtp+xtp2))/n
+
+
+# derivatives of batch_interp_tunes along tangents of the tracks
+def batch_interp_tune_derivatives(trks, dtrks, planes=(0, 2)):
+    # trks has shape (n, particles, 6) and dtrks, the derivatives of the
+    # tracks in some directions, (n, directions, particles, 6). The
+    # peak bins are those of batch_interp_tunes, only the amplitudes
+    # there change. Returns an array of shape (directions, particles,
+    # len(planes)).
+    n = trks.shape[0]
+    maxn = int(n/2)
+    xf = np.fft.rfft(trks[:, :, list(planes)], axis=0)
+    dxf = np.fft.rfft(dtrks[..., list(planes)], axis=0)
+    xt = np.abs(xf)
+    xt[0:10] = 0.0
+    locmax = np.argmax(xt[0:maxn], axis=0)
+    lower = np.take_along_axis(xt, np.maximum(locmax-1, 0)[np.newaxis], axis=0)[0] > \
+        np.take_along_axis(xt, (locmax+1)[np.newaxis], axis=0)[0]
+    dir = np.where(lower, -1.0, 1.0)
+    other = np.where(lower, np.maximum(locmax-1, 0), locmax+1)
+
+    # amplitude and its derivatives at the bins
+    def at(bins):
+        f = np.take_along_axis(xf, bins[np.newaxis], axis=0)[0]
+        df = np.take_along_axis(dxf, bins[np.newaxis, np.newaxis], axis=0)[0]
+        a = np.abs(f)
+        return (a, np.real(np.conj(f)*df)/a)
+
+    (xtp, dxtp) = at(locmax)
+    (xtp2, dxtp2) = at(other)
+    return dir*(xtp*dxtp2 - xtp2*dxtp)/(xtp+xtp2)**2/n
+
+
 # get the (fractional) tunes of a set of coordinates from a single track
 def refined_tunes(coords):
     # coords has shape (6,n)
@@ -111,3 +164,23 @@ def refined_tunes(coords):
     tunerange = (xrange,yrange,zrange)
     ctunes = cft_tunes(coords, tunerange)
     return ctunes
+
+
+# get the x and y eigentunes of a 4x4 linear one turn map in
+# (x, x', y, y'). The eigenmodes are assigned to x and y by which plane
+# dominates their eigenvectors. Raises RuntimeError if an eigenvalue
+# modulus is beyond 1+tol or the map has real eigenvalues.
+def eigentunes(one_turn_map, tol=0.0):
+    (evals, evecs) = np.linalg.eig(one_turn_map)
+    if not np.all(np.abs(evals) <= 1.0 + tol):
+        raise RuntimeError("one turn map eigenvalue modulus {}".format(np.max(np.abs(evals))))
+
+    # one of each conjugate pair
+    modes = [k for k in range(4) if evals[k].imag > 0.0]
+    if len(modes) != 2:
+        raise RuntimeError("one turn map has real eigenvalues {}".format(evals))
+    tunes = [np.abs(np.angle(evals[k]))/(2.0*np.pi) for k in modes]
+    xweights = [np.sum(np.abs(evecs[0:2, k])**2) for k in modes]
+    if xweights[0] >= xweights[1]:
+        return tunes[0], tunes[1]
+    return tunes[1], tunes[0]